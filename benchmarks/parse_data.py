@@ -0,0 +1,199 @@
+"""Micro-benchmarks of the parse_data hot paths.
+
+Every report runs parse_data of the entities of its device plus
+XiaomiDevice.parse_voltage. This replays the recorded payloads of
+payloads.json through the entities each model creates and reports, per
+model and entity class, the time per call and the memory allocated per call
+(the tracemalloc peak above the baseline, in bytes).
+
+    python benchmarks/parse_data.py
+    python benchmarks/parse_data.py --save baseline.json
+    python benchmarks/parse_data.py --compare baseline.json --threshold 0.15
+
+With --compare the exit code is 1 when a case got slower than the threshold,
+so the suite can gate a release. Requires Home Assistant and PyXiaomiGateway.
+"""
+import argparse
+import gc
+import importlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from xiaomi_aqara_custom import DEVICE_TYPES, XiaomiDevice  # noqa: E402
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads.json")
+MIN_TIME = 0.2
+REPEAT = 5
+
+
+class _Bus:
+    """Event bus counting the events parse_data fires."""
+
+    def __init__(self):
+        self.fired = 0
+
+    def fire(self, event_type, event_data=None):
+        self.fired += 1
+
+
+def _gateway():
+    """Return the hub attributes the entities use on construction."""
+    return SimpleNamespace(
+        sid="7811dcb1c2d3",
+        write_to_hub=lambda sid, **data: True,
+        get_from_hub=lambda sid: True,
+    )
+
+
+def _create_entities(hass, model, message):
+    """Create the entities of a model like the platforms do."""
+    device = {
+        "model": model,
+        "proto": "1.1.2",
+        "sid": message["sid"],
+        "short_id": message["short_id"],
+        "data": {},
+        "raw_data": {"cmd": "read_ack", "model": model, "sid": message["sid"]},
+    }
+    entities = []
+    for device_type, models in DEVICE_TYPES.items():
+        if model not in models:
+            continue
+        platform = importlib.import_module(f"xiaomi_aqara_custom.{device_type}")
+        if device_type == "lock":
+            created = platform._create_entities(device, _gateway())
+        else:
+            created = platform._create_entities(hass, device, _gateway())
+        for entity in created:
+            entity.hass = hass
+            entities.append(entity)
+    return entities
+
+
+def _time_per_call(func, payloads):
+    """Return the best time per call in ns, timeit style."""
+    calls = len(payloads)
+    loops = 1
+    while True:
+        started = time.perf_counter_ns()
+        for _ in range(loops):
+            for data, raw_data in payloads:
+                func(data, raw_data)
+        elapsed = time.perf_counter_ns() - started
+        if elapsed >= MIN_TIME * 1e9:
+            break
+        loops *= 2
+
+    best = elapsed
+    for _ in range(REPEAT - 1):
+        started = time.perf_counter_ns()
+        for _ in range(loops):
+            for data, raw_data in payloads:
+                func(data, raw_data)
+        best = min(best, time.perf_counter_ns() - started)
+    return best / (loops * calls)
+
+
+def _bytes_per_call(func, payloads):
+    """Return the mean memory allocated while a call runs."""
+    total = 0
+    tracemalloc.start()
+    try:
+        for data, raw_data in payloads:
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            func(data, raw_data)
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - baseline
+    finally:
+        tracemalloc.stop()
+    return total / len(payloads)
+
+
+def run(models=None):
+    """Run the benchmarks, returns {case: {"ns": ..., "bytes": ...}}."""
+    with open(PAYLOADS) as payloads_file:
+        recorded = json.load(payloads_file)
+
+    hass = SimpleNamespace(bus=_Bus())
+    results = {}
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for model, messages in recorded.items():
+            if models and model not in models:
+                continue
+            payloads = [(json.loads(message["data"]), message) for message in messages]
+            entities = _create_entities(hass, model, messages[0])
+            for entity in entities:
+                case = f"{model}/{type(entity).__name__}/{entity.name}"
+                results[case] = {
+                    "ns": _time_per_call(entity.parse_data, payloads),
+                    "bytes": _bytes_per_call(entity.parse_data, payloads),
+                }
+            if entities:
+                voltage = entities[0]
+                results[f"{model}/{XiaomiDevice.__name__}/parse_voltage"] = {
+                    "ns": _time_per_call(
+                        lambda data, _: voltage.parse_voltage(data), payloads
+                    ),
+                    "bytes": _bytes_per_call(
+                        lambda data, _: voltage.parse_voltage(data), payloads
+                    ),
+                }
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the cases slower than the baseline, returns True if any."""
+    regressed = False
+    for case, result in results.items():
+        before = baseline.get(case)
+        if before is None:
+            continue
+        change = result["ns"] / before["ns"] - 1
+        if change > threshold:
+            regressed = True
+            print(
+                f"REGRESSION {case}: {before['ns']:.0f} -> {result['ns']:.0f} ns/op"
+                f" ({change:+.0%})"
+            )
+    return regressed
+
+
+def main():
+    """Run the suite and print a table."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("models", nargs="*", help="only these models")
+    parser.add_argument("--save", help="write the results to a JSON file")
+    parser.add_argument("--compare", help="baseline JSON file")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    results = run(args.models)
+    width = max(len(case) for case in results)
+    print(f"{'case':<{width}}  {'ns/op':>9}  {'B/op':>7}")
+    for case, result in results.items():
+        print(f"{case:<{width}}  {result['ns']:>9.0f}  {result['bytes']:>7.0f}")
+
+    if args.save:
+        with open(args.save, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            if compare(results, json.load(baseline_file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
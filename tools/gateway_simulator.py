@@ -0,0 +1,415 @@
+"""Simulator of the Xiaomi Gateway multicast and unicast protocol.
+
+Emulates N gateways with M sub-devices each, speaking protocol 1.x:
+answers whois, get_id_list, read and write, multicasts heartbeats and
+sends reports at a configurable rate. Each gateway listens on its own
+loopback address (127.0.1.1, 127.0.1.2, ...), so the test instance needs
+
+    xiaomi_aqara_custom:
+      interface: 127.0.0.1
+      gateways:
+        - mac: <printed by the simulator>
+          key: <--key>
+
+Every report changes the state of exactly one entity of the device (the
+probe key of its model), so the state changes can be matched to the
+reports by tools/push_benchmark.py.
+
+    python tools/gateway_simulator.py --gateways 2 --devices 20 --rate 50
+"""
+import argparse
+import asyncio
+from collections import Counter
+import itertools
+import json
+import logging
+import socket
+import struct
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from miio_emulator import DEFAULT_TOKEN, async_start_emulator
+
+_LOGGER = logging.getLogger(__name__)
+
+MULTICAST_ADDRESS = "224.0.0.50"
+MULTICAST_PORT = 9898
+GATEWAY_DISCOVERY_PORT = 4321
+LOOPBACK = "127.0.0.1"
+DEFAULT_KEY = "0123456789abcdef"
+AES_IV = bytes.fromhex("17996d093d28ddb3ba695a2e6f58562e")
+HEARTBEAT_INTERVAL = 10.0
+
+
+def _temperature(seq):
+    raw = 1000 + (seq % 400) * 10
+    return {"temperature": str(raw)}, str(round(raw / 100, 1))
+
+
+def _lux(seq):
+    lux = seq % 1000
+    return {"lux": str(lux)}, str(lux)
+
+
+def _toggle(key, on_value, off_value):
+    def probe(seq):
+        if seq % 2:
+            return {key: on_value}, "on"
+        return {key: off_value}, "off"
+
+    return probe
+
+
+# Models of binary_sensor.py, sensor.py and switch.py:
+# model -> (initial data, probe returning (report data, expected state))
+MODELS = {
+    "sensor_ht": ({"temperature": "2100", "humidity": "4500"}, _temperature),
+    "weather.v1": (
+        {"temperature": "2100", "humidity": "4500", "pressure": "100300"},
+        _temperature,
+    ),
+    "sensor_motion.aq2": ({"lux": "10"}, _lux),
+    "magnet": ({"status": "close"}, _toggle("status", "open", "close")),
+    "sensor_magnet.aq2": ({"status": "close"}, _toggle("status", "open", "close")),
+    "sensor_wleak.aq1": (
+        {"status": "no_leak"},
+        _toggle("status", "leak", "no_leak"),
+    ),
+    "plug": (
+        {"status": "off", "inuse": "0", "load_power": "0.00"},
+        _toggle("status", "on", "off"),
+    ),
+    "ctrl_neutral1": ({"channel_0": "off"}, _toggle("channel_0", "on", "off")),
+    "ctrl_ln2": (
+        {"channel_0": "off", "channel_1": "off"},
+        _toggle("channel_0", "on", "off"),
+    ),
+}
+
+
+class SimulatedDevice:
+    """A sub-device with its current data."""
+
+    def __init__(self, sid, model, short_id):
+        """Initialize the device with the initial data of its model."""
+        self.sid = sid
+        self.model = model
+        self.short_id = short_id
+        self.data = dict(MODELS[model][0], voltage="3005")
+        self._seq = itertools.count(1)
+
+    def next_report(self):
+        """Return the data of the next report and the state it sets."""
+        data, expected = MODELS[self.model][1](next(self._seq))
+        self.data.update(data)
+        return data, expected
+
+    def message(self, cmd, data):
+        """Build a message about this device."""
+        return {
+            "cmd": cmd,
+            "model": self.model,
+            "sid": self.sid,
+            "short_id": self.short_id,
+            "data": json.dumps(data),
+        }
+
+
+class SimulatedGateway(asyncio.DatagramProtocol):
+    """Answer the unicast commands of one gateway."""
+
+    def __init__(self, index, num_devices, key=DEFAULT_KEY):
+        """Create the gateway and its sub-devices."""
+        self.ip = f"127.0.1.{index + 1}"
+        self.sid = f"7811dc{index:06x}"
+        self.key = key
+        self.token = f"{index:016x}"
+        self.stats = Counter()
+        self.devices = {}
+        models = itertools.cycle(MODELS)
+        for number in range(num_devices):
+            sid = f"158d00{index:02x}{number:04x}"
+            self.devices[sid] = SimulatedDevice(sid, next(models), number + 1)
+        self._transport = None
+
+    def connection_made(self, transport):
+        """Keep the transport."""
+        self._transport = transport
+
+    def iam(self):
+        """Return the answer to whois."""
+        return {
+            "cmd": "iam",
+            "ip": self.ip,
+            "port": str(MULTICAST_PORT),
+            "model": "gateway",
+            "sid": self.sid,
+            "proto_version": "1.1.2",
+        }
+
+    def heartbeat(self):
+        """Return a heartbeat of the gateway, carrying a fresh token."""
+        return {
+            "cmd": "heartbeat",
+            "model": "gateway",
+            "sid": self.sid,
+            "short_id": "0",
+            "token": self.token,
+            "data": json.dumps({"ip": self.ip}),
+        }
+
+    def _expected_key(self):
+        encryptor = Cipher(
+            algorithms.AES(self.key.encode()), modes.CBC(AES_IV),
+            backend=default_backend()).encryptor()
+        encrypted = encryptor.update(self.token.encode()) + encryptor.finalize()
+        return encrypted.hex()
+
+    def datagram_received(self, data, addr):
+        """Answer get_id_list, read and write."""
+        try:
+            request = json.loads(data.decode())
+            cmd = request["cmd"]
+        except (ValueError, KeyError):
+            self.stats["malformed"] += 1
+            return
+        self.stats[cmd] += 1
+
+        if cmd == "get_id_list":
+            response = {
+                "cmd": "get_id_list_ack",
+                "sid": self.sid,
+                "token": self.token,
+                "data": json.dumps(list(self.devices)),
+            }
+        elif cmd == "read":
+            device = self.devices.get(request.get("sid"))
+            if device is None:
+                response = {"cmd": "read_ack", "sid": request.get("sid"),
+                            "data": json.dumps({"error": "No device"})}
+            else:
+                response = device.message("read_ack", device.data)
+        elif cmd == "write":
+            response = self._write(request)
+        else:
+            return
+        self._transport.sendto(json.dumps(response).encode(), addr)
+
+    def _write(self, request):
+        device = self.devices.get(request.get("sid"))
+        data = request.get("data", {})
+        if isinstance(data, str):
+            data = json.loads(data)
+        key = data.pop("key", None)
+        if device is None:
+            return {"cmd": "write_ack", "sid": request.get("sid"),
+                    "data": json.dumps({"error": "No device"})}
+        if key != self._expected_key():
+            self.stats["invalid_key"] += 1
+            return device.message("write_ack", {"error": "Invalid key"})
+        device.data.update(data)
+        return device.message("write_ack", device.data)
+
+
+class GatewaySimulator:
+    """Run the gateways and send their reports and heartbeats."""
+
+    def __init__(
+        self, num_gateways, num_devices, rate, key=DEFAULT_KEY,
+        heartbeat_interval=HEARTBEAT_INTERVAL, on_report=None):
+        """Initialize the simulator, rate is in reports per second per gateway."""
+        self.gateways = [
+            SimulatedGateway(index, num_devices, key) for index in range(num_gateways)
+        ]
+        self.sent = 0
+        self._rate = rate
+        self._heartbeat_interval = heartbeat_interval
+        self._on_report = on_report
+        self._senders = {}
+        self._transports = []
+        self._tasks = []
+
+    @staticmethod
+    def _sender(ip_address):
+        """Create a socket multicasting from the address of a gateway."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        sock.setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(LOOPBACK)
+        )
+        sock.bind((ip_address, 0))
+        return sock
+
+    @staticmethod
+    def _whois_socket():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", GATEWAY_DISCOVERY_PORT))
+        mreq = struct.pack(
+            "4s4s", socket.inet_aton(MULTICAST_ADDRESS), socket.inet_aton(LOOPBACK)
+        )
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        return sock
+
+    async def async_start(self, miio_token=None, reports=True, **miio_options):
+        """Open the sockets and start sending, reports only if requested."""
+        loop = asyncio.get_event_loop()
+        for gateway in self.gateways:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((gateway.ip, MULTICAST_PORT))
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda gateway=gateway: gateway, sock=sock
+            )
+            self._transports.append(transport)
+            self._senders[gateway.sid] = self._sender(gateway.ip)
+            if miio_token:
+                transport, _ = await async_start_emulator(
+                    gateway.ip, token=miio_token, **miio_options
+                )
+                self._transports.append(transport)
+
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _WhoisResponder(self.gateways), sock=self._whois_socket()
+        )
+        self._transports.append(transport)
+
+        for gateway in self.gateways:
+            self._tasks.append(loop.create_task(self._async_heartbeats(gateway)))
+        if reports:
+            self.start_reports()
+
+    def start_reports(self):
+        """Start sending reports at the configured rate."""
+        if not self._rate:
+            return
+        loop = asyncio.get_event_loop()
+        for gateway in self.gateways:
+            self._tasks.append(loop.create_task(self._async_reports(gateway)))
+
+    def stop(self):
+        """Stop sending and close the sockets."""
+        for task in self._tasks:
+            task.cancel()
+        for transport in self._transports:
+            transport.close()
+        for sock in self._senders.values():
+            sock.close()
+
+    def _multicast(self, gateway, message):
+        self._senders[gateway.sid].sendto(
+            json.dumps(message).encode(), (MULTICAST_ADDRESS, MULTICAST_PORT)
+        )
+
+    async def _async_heartbeats(self, gateway):
+        while True:
+            self._multicast(gateway, gateway.heartbeat())
+            for device in gateway.devices.values():
+                self._multicast(
+                    gateway,
+                    device.message("heartbeat", {"voltage": device.data["voltage"]}),
+                )
+            await asyncio.sleep(self._heartbeat_interval)
+
+    async def _async_reports(self, gateway):
+        """Send reports round robin over the devices, at a steady rate."""
+        interval = 1 / self._rate
+        devices = itertools.cycle(list(gateway.devices.values()))
+        next_send = time.monotonic()
+        while True:
+            # Catch up in a burst when the loop fell behind
+            while next_send <= time.monotonic():
+                device = next(devices)
+                data, expected = device.next_report()
+                sent_at = time.time()
+                self._multicast(gateway, device.message("report", data))
+                self.sent += 1
+                if self._on_report is not None:
+                    self._on_report(device.sid, expected, sent_at)
+                next_send += interval
+            await asyncio.sleep(next_send - time.monotonic())
+
+
+class _WhoisResponder(asyncio.DatagramProtocol):
+    """Answer whois for all simulated gateways."""
+
+    def __init__(self, gateways):
+        """Initialize the responder."""
+        self._gateways = gateways
+        self._transport = None
+
+    def connection_made(self, transport):
+        """Keep the transport."""
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        """Answer whois with one iam per gateway."""
+        try:
+            request = json.loads(data.decode())
+        except ValueError:
+            return
+        if request.get("cmd") != "whois":
+            return
+        for gateway in self._gateways:
+            self._transport.sendto(json.dumps(gateway.iam()).encode(), addr)
+
+
+def add_arguments(parser):
+    """Add the simulator options to an argument parser."""
+    parser.add_argument("--gateways", type=int, default=1)
+    parser.add_argument("--devices", type=int, default=10, help="per gateway")
+    parser.add_argument(
+        "--rate", type=float, default=10.0, help="reports per second per gateway"
+    )
+    parser.add_argument("--key", default=DEFAULT_KEY, help="gateway password")
+    parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL)
+    parser.add_argument(
+        "--miio-token", nargs="?", const=DEFAULT_TOKEN,
+        help="also emulate the MIIO side of the gateways")
+
+
+def print_config(simulator, args):
+    """Print the configuration for the test instance."""
+    print("xiaomi_aqara_custom:")
+    print(f"  interface: {LOOPBACK}")
+    print("  gateways:")
+    for gateway in simulator.gateways:
+        print(f"    - mac: {gateway.sid}")
+        print(f"      key: {args.key}")
+        if args.miio_token:
+            print(f"      miio_token: {args.miio_token}")
+
+
+def main():
+    """Run the simulator until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    simulator = GatewaySimulator(
+        args.gateways, args.devices, args.rate, args.key, args.heartbeat
+    )
+    print_config(simulator, args)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(simulator.async_start(args.miio_token))
+    started = time.monotonic()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+        elapsed = time.monotonic() - started
+        _LOGGER.info(
+            "Sent %s reports in %.1f s (%.1f/s)",
+            simulator.sent, elapsed, simulator.sent / elapsed)
+        for gateway in simulator.gateways:
+            _LOGGER.info("%s: %s", gateway.sid, dict(gateway.stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Local emulator of the MIIO side of a Xiaomi Gateway.
+
+Speaks the token-encrypted MIIO protocol over UDP and answers the commands
+listed in API.md, so the radio and alarm switches and the radio volume
+service can be exercised and benchmarked without a physical gateway.
+Latency, response jitter and packet loss are configurable.
+
+    python tools/miio_emulator.py --host 127.0.0.2 --latency 20 --jitter 10 --loss 0.05
+
+Point a gateway at the emulator address (e.g. with a discovery cache entry or
+the multicast simulator) and use the same miio_token in the configuration.
+Requires cryptography and python-miio, for the codec of the integration.
+"""
+import argparse
+import asyncio
+from collections import Counter
+import logging
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The codec of the integration, imported without the Home Assistant package
+sys.path.insert(0, os.path.join(ROOT, "xiaomi_aqara_custom"))
+from miio_client import HEADER, MAGIC, MiioCodec  # noqa: E402
+
+_LOGGER = logging.getLogger(__name__)
+
+MIIO_PORT = 54321
+DEFAULT_TOKEN = "00112233445566778899aabbccddeeff"
+
+
+def _hello(device_id, stamp):
+    """Build the answer to a handshake."""
+    return HEADER.pack(MAGIC, 32, 0, device_id, stamp) + b"\xff" * 16
+
+
+class GatewayState:
+    """Radio and alarm state of the emulated gateway, one method per command."""
+
+    def __init__(self, host, token):
+        """Initialize the state."""
+        self.host = host
+        self.token = token
+        self.fm_status = "pause"
+        self.volume = 50
+        self.program = 0
+        self.channels = []
+        self.arming = "off"
+        self.arm_wait_time = 5
+
+    def handler(self, method):
+        """Return the handler of a command, or None for unknown ones."""
+        if not method or method.startswith("_"):
+            return None
+        return getattr(self, "_" + method.replace(".", "_"), None)
+
+    def _miIO_info(self, params):
+        return {
+            "model": "lumi.gateway.v3",
+            "token": self.token,
+            "fw_ver": "1.4.1_175",
+            "hw_ver": "MW300",
+            "mac": "34:CE:00:00:00:01",
+            "netif": {"localIp": self.host, "mask": "255.255.255.0", "gw": ""},
+        }
+
+    def _get_prop_fm(self, params):
+        return {
+            "current_program": self.program,
+            "current_progress": 0,
+            "current_status": self.fm_status,
+            "current_volume": self.volume,
+        }
+
+    def _play_fm(self, params):
+        action = params[0]
+        if action == "toggle":
+            action = "off" if self.fm_status == "run" else "on"
+        if action in ("next", "prev") and self.channels:
+            step = 1 if action == "next" else -1
+            ids = [channel["id"] for channel in self.channels]
+            index = ids.index(self.program) if self.program in ids else 0
+            self.program = ids[(index + step) % len(ids)]
+            action = "on"
+        if action == "on":
+            self.fm_status = "run"
+        elif action == "off":
+            self.fm_status = "pause"
+        return ["ok"]
+
+    def _play_specify_fm(self, params):
+        self.program = params[0]
+        if len(params) > 1:
+            self.volume = int(params[1])
+        self.fm_status = "run"
+        return ["ok"]
+
+    def _volume_ctrl_fm(self, params):
+        self.volume = max(0, min(100, int(params[0])))
+        return ["ok"]
+
+    def _add_channels(self, params):
+        for channel in params["chs"]:
+            self.channels = [c for c in self.channels if c["id"] != channel["id"]]
+            self.channels.append(channel)
+        return ["ok"]
+
+    def _remove_channels(self, params):
+        ids = {channel["id"] for channel in params["chs"]}
+        self.channels = [c for c in self.channels if c["id"] not in ids]
+        return ["ok"]
+
+    def _get_arming(self, params):
+        return [self.arming]
+
+    def _set_arming(self, params):
+        self.arming = params[0]
+        return ["ok"]
+
+    def _get_arm_wait_time(self, params):
+        return [self.arm_wait_time]
+
+
+class MiioGatewayEmulator(asyncio.DatagramProtocol):
+    """Answer MIIO requests with a configurable latency, jitter and loss."""
+
+    def __init__(
+        self, host, token=DEFAULT_TOKEN, device_id=0x01020304,
+        latency=0.0, jitter=0.0, loss=0.0, rng=None):
+        """Initialize the emulator, latency and jitter are in seconds."""
+        self.state = GatewayState(host, token)
+        self.stats = Counter()
+        self._codec = MiioCodec(bytes.fromhex(token))
+        self._device_id = device_id
+        self._latency = latency
+        self._jitter = jitter
+        self._loss = loss
+        self._rng = rng or random.Random()
+        self._started = time.monotonic()
+        self._transport = None
+
+    def connection_made(self, transport):
+        """Keep the transport."""
+        self._transport = transport
+
+    def _stamp(self):
+        return int(time.monotonic() - self._started) + 1
+
+    def datagram_received(self, data, addr):
+        """Answer a handshake or a command."""
+        if self._rng.random() < self._loss:
+            self.stats["dropped"] += 1
+            return
+
+        try:
+            _, _, request = self._codec.parse(data)
+        except ValueError as error:
+            self.stats["malformed"] += 1
+            _LOGGER.debug("Dropping packet from %s: %s", addr, error)
+            return
+
+        if request is None:
+            self.stats["hello"] += 1
+            response = _hello(self._device_id, self._stamp())
+        else:
+            method = request.get("method", "")
+            self.stats[method] += 1
+            payload = {"id": request.get("id")}
+            handler = self.state.handler(method)
+            if handler is None:
+                payload["error"] = {"code": -32601, "message": "Method not found."}
+            else:
+                try:
+                    payload["result"] = handler(request.get("params"))
+                except (IndexError, KeyError, TypeError, ValueError):
+                    payload["error"] = {"code": -32602, "message": "Invalid params."}
+            response = self._codec.build(payload, self._device_id, self._stamp())
+
+        delay = self._latency + self._rng.uniform(0, self._jitter)
+        asyncio.get_event_loop().call_later(delay, self._reply, response, addr)
+
+    def _reply(self, response, addr):
+        if self._transport is not None:
+            self._transport.sendto(response, addr)
+
+
+async def async_start_emulator(host, port=MIIO_PORT, **kwargs):
+    """Start an emulator, returns (transport, emulator)."""
+    return await asyncio.get_event_loop().create_datagram_endpoint(
+        lambda: MiioGatewayEmulator(host, **kwargs), local_addr=(host, port)
+    )
+
+
+def main():
+    """Run an emulator until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=MIIO_PORT)
+    parser.add_argument("--token", default=DEFAULT_TOKEN)
+    parser.add_argument("--latency", type=float, default=0.0, help="ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="0..1")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    loop = asyncio.get_event_loop()
+    transport, emulator = loop.run_until_complete(
+        async_start_emulator(
+            args.host, args.port, token=args.token,
+            latency=args.latency / 1000, jitter=args.jitter / 1000,
+            loss=args.loss, rng=random.Random(args.seed)))
+    _LOGGER.info("MIIO gateway emulator on %s:%s", args.host, args.port)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transport.close()
+        _LOGGER.info("Requests: %s", dict(emulator.stats))
+
+
+if __name__ == "__main__":
+    main()
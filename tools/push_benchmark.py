@@ -0,0 +1,209 @@
+"""Measure the push path of a Home Assistant test instance end to end.
+
+Runs the gateway simulator at the requested rate and follows the
+state_changed events of the instance over its websocket API. Every report
+is matched to the state change it causes, giving the latency from the
+multicast send to the state write, and the throughput of state changes.
+
+    python tools/push_benchmark.py --url http://localhost:8123 \\
+        --token <long-lived access token> --gateways 2 --devices 50 \\
+        --rate 200 --duration 60
+
+The instance must be configured with the gateways printed by
+tools/gateway_simulator.py for the same --gateways and --key. The benchmark
+starts the simulated gateways first, so the instance may be (re)started
+after it, and only sends reports once the instance has entities for all
+simulated devices. Both must run on the same host, the latency is taken
+from the event's time_fired.
+"""
+import argparse
+import asyncio
+from collections import defaultdict, deque
+from datetime import datetime
+import logging
+import time
+
+import aiohttp
+
+from gateway_simulator import GatewaySimulator, add_arguments
+
+_LOGGER = logging.getLogger(__name__)
+
+SETTLE_TIME = 5.0
+SETUP_POLL_INTERVAL = 2.0
+
+
+class PushBenchmark:
+    """Match the reports of the simulator to state changes."""
+
+    def __init__(self):
+        """Initialize the counters."""
+        self.latencies = []
+        self.superseded = 0
+        self.unmatched = 0
+        self._pending = defaultdict(deque)
+
+    def report_sent(self, sid, expected, sent_at):
+        """Remember a report until its state change arrives."""
+        self._pending[sid].append((expected, sent_at))
+
+    def state_changed(self, event):
+        """Match a state change to the oldest report setting that state."""
+        entity_id = event["data"]["entity_id"]
+        new_state = event["data"].get("new_state")
+        if new_state is None:
+            return
+        old_state = event["data"].get("old_state")
+        # Heartbeats only touch attributes
+        if old_state is not None and old_state["state"] == new_state["state"]:
+            return
+        pending = self._pending.get(entity_id.rsplit("_", 1)[-1])
+        if not pending:
+            return
+
+        skipped = 0
+        for expected, sent_at in pending:
+            if expected == new_state["state"]:
+                break
+            skipped += 1
+        else:
+            self.unmatched += 1
+            return
+
+        for _ in range(skipped + 1):
+            pending.popleft()
+        # Reports passed over were merged into a later write or lost
+        self.superseded += skipped
+        fired = datetime.fromisoformat(event["time_fired"]).timestamp()
+        self.latencies.append(fired - sent_at)
+
+    @property
+    def outstanding(self):
+        """Return the number of reports without a state change yet."""
+        return sum(len(pending) for pending in self._pending.values())
+
+
+async def async_follow_states(session, url, token, benchmark, subscribed):
+    """Feed the state_changed events of the instance to the benchmark."""
+    async with session.ws_connect(f"{url}/api/websocket") as websocket:
+        await websocket.receive_json()
+        await websocket.send_json({"type": "auth", "access_token": token})
+        auth = await websocket.receive_json()
+        if auth["type"] != "auth_ok":
+            raise RuntimeError(f"Authentication failed: {auth}")
+        await websocket.send_json(
+            {"id": 1, "type": "subscribe_events", "event_type": "state_changed"}
+        )
+        subscribed.set_result(None)
+        async for message in websocket:
+            payload = message.json()
+            if payload.get("type") == "event":
+                benchmark.state_changed(payload["event"])
+
+
+async def async_wait_for_entities(session, url, token, sids, timeout):
+    """Wait until the instance has an entity for every sid."""
+    headers = {"Authorization": f"Bearer {token}"}
+    deadline = time.monotonic() + timeout
+    missing = set(sids)
+    while True:
+        try:
+            async with session.get(f"{url}/api/states", headers=headers) as resp:
+                resp.raise_for_status()
+                states = await resp.json()
+        except aiohttp.ClientError as error:
+            _LOGGER.debug("Instance not ready: %s", error)
+        else:
+            missing = set(sids) - {
+                state["entity_id"].rsplit("_", 1)[-1] for state in states
+            }
+            if not missing:
+                return
+        if time.monotonic() > deadline:
+            raise RuntimeError(
+                f"No entities for {len(missing)} of {len(sids)} simulated devices"
+            )
+        _LOGGER.info("Waiting for %s devices to be set up", len(missing))
+        await asyncio.sleep(SETUP_POLL_INTERVAL)
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def print_results(simulator, benchmark, duration):
+    """Print throughput and latency."""
+    latencies = sorted(benchmark.latencies)
+    print(f"reports sent:     {simulator.sent} ({simulator.sent / duration:.1f}/s)")
+    print(
+        f"state changes:    {len(latencies)} ({len(latencies) / duration:.1f}/s)"
+    )
+    print(f"superseded:       {benchmark.superseded}")
+    print(f"no state change:  {benchmark.outstanding}")
+    print(f"unmatched states: {benchmark.unmatched}")
+    if latencies:
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            print(f"latency {name}:      {_percentile(latencies, fraction) * 1000:.1f} ms")
+        print(f"latency max:      {latencies[-1] * 1000:.1f} ms")
+
+
+async def async_main(args):
+    """Run the simulator against the instance for the requested duration."""
+    benchmark = PushBenchmark()
+    simulator = GatewaySimulator(
+        args.gateways, args.devices, args.rate, args.key, args.heartbeat,
+        on_report=benchmark.report_sent)
+
+    # Answer discovery and reads while the instance sets the gateways up
+    await simulator.async_start(args.miio_token, reports=False)
+    try:
+        async with aiohttp.ClientSession() as session:
+            sids = [sid for gateway in simulator.gateways for sid in gateway.devices]
+            await async_wait_for_entities(
+                session, args.url, args.token, sids, args.setup_timeout
+            )
+            subscribed = asyncio.get_event_loop().create_future()
+            follower = asyncio.ensure_future(
+                async_follow_states(
+                    session, args.url, args.token, benchmark, subscribed
+                )
+            )
+            await asyncio.wait(
+                [subscribed, follower], return_when=asyncio.FIRST_COMPLETED
+            )
+            if follower.done():
+                follower.result()
+
+            simulator.start_reports()
+            started = time.monotonic()
+            await asyncio.sleep(args.duration)
+            simulator.stop()
+            duration = time.monotonic() - started
+            # Let the instance work off its backlog
+            await asyncio.sleep(SETTLE_TIME)
+            follower.cancel()
+    finally:
+        simulator.stop()
+
+    print_results(simulator, benchmark, duration)
+
+
+def main():
+    """Parse the options and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--url", default="http://localhost:8123")
+    parser.add_argument("--token", required=True, help="long-lived access token")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument(
+        "--setup-timeout", type=float, default=120.0,
+        help="seconds to wait for the instance to set the devices up",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    asyncio.get_event_loop().run_until_complete(async_main(args))
+
+
+if __name__ == "__main__":
+    main()
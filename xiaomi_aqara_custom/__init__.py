@@ -2,30 +2,60 @@
 Support for Xiaomi Gateways.
 Custom update with MIIO protocol
 """
+from collections import Counter, defaultdict
 from datetime import timedelta
+import asyncio
+import functools
 import logging
+import platform
+import re
 import socket
+import struct
 import json
-import miio
+import time
 
+from miio.exceptions import DeviceException
 import voluptuous as vol
-from xiaomi_gateway import XiaomiGatewayDiscovery, XiaomiGateway, GATEWAY_MODELS
+from xiaomi_gateway import (
+    XiaomiGatewayDiscovery,
+    XiaomiGateway,
+    GATEWAY_MODELS,
+    _get_value,
+    _list2map,
+    _validate_data,
+)
 
 from homeassistant.components.discovery import SERVICE_XIAOMI_GW
 from homeassistant.const import (
     ATTR_BATTERY_LEVEL,
+    ATTR_ENTITY_ID,
     ATTR_VOLTAGE,
     CONF_HOST,
     CONF_MAC,
     CONF_PORT,
+    EVENT_HOMEASSISTANT_START,
     EVENT_HOMEASSISTANT_STOP,
 )
-from homeassistant.core import callback
+from homeassistant.core import CoreState, callback
 from homeassistant.helpers import discovery
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.dispatcher import (
+    async_dispatcher_connect,
+    async_dispatcher_send,
+)
 from homeassistant.helpers.entity import Entity
-from homeassistant.helpers.event import async_track_point_in_utc_time
-from homeassistant.util.dt import utcnow
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import Store
+
+from .coordinator import GatewayMiioCoordinator
+from .miio_client import AsyncMiioClient, MiioCommandQueue
+from .timers import GatewayTimers
+from .writer import (
+    WRITE_PRIORITY_NORMAL,
+    WRITE_PRIORITY_SAFETY,
+    WRITE_QUEUE_SIZE,
+    GatewayWriter,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -34,8 +64,11 @@ ATTR_RINGTONE_ID = "ringtone_id"
 ATTR_RINGTONE_VOL = "ringtone_vol"
 ATTR_DEVICE_ID = "device_id"
 ATTR_RADIO_VOLUME = "volume"
+ATTR_SIDS = "sids"
+ATTR_STATE = "state"
 
 CONF_DISCOVERY_RETRY = "discovery_retry"
+CONF_DUPLICATE_WINDOW = "duplicate_window"
 CONF_GATEWAYS = "gateways"
 CONF_INTERFACE = "interface"
 CONF_KEY = "key"
@@ -45,14 +78,105 @@ CONF_MIIO_TOKEN = "miio_token"
 DOMAIN = "xiaomi_aqara_custom"
 
 PY_XIAOMI_GATEWAY = "xiaomi_gw"
+DEVICE_STATES = "xiaomi_gw_states"
+
+STORAGE_VERSION = 1
+STORAGE_KEY_DISCOVERY = f"{DOMAIN}.discovery"
+STORAGE_KEY_INVENTORY = f"{DOMAIN}.inventory"
+STORAGE_KEY_STATES = f"{DOMAIN}.states"
 
 TIME_TILL_UNAVAILABLE = timedelta(minutes=150)
 
+DISCOVERY_TIMEOUT = 5.0
+DISCOVERY_SETTLE_TIME = 0.3
+DISCOVERY_SETTLE_FACTOR = 4
+DISCOVERY_CACHE_SAVE_DELAY = 10
+# A cached gateway must answer a read of itself within this time
+CACHE_PROBE_TIMEOUT = 1.0
+INVENTORY_SAVE_DELAY = 10
+STATE_SAVE_INTERVAL = timedelta(minutes=15)
+REDISCOVERY_INTERVAL = timedelta(minutes=10)
+
+MAX_PARALLEL_BRINGUP = 4
+# Writes of a bulk_switch call queued per gateway at once, leaving room in
+# the write queue for other writes
+BULK_SWITCH_PARALLEL = WRITE_QUEUE_SIZE // 2
+ENUMERATION_WINDOW = 8
+ENUMERATION_TIMEOUT = 2.0
+PENDING_DEVICES_INTERVAL = timedelta(seconds=30)
+# Retries of silent sub-devices back off from the interval, doubling, and
+# stop after PENDING_DEVICES_MAX_ATTEMPTS rounds without any answer
+PENDING_DEVICES_MAX_ATTEMPTS = 8
+
+# A gateway sends a heartbeat every 10 seconds
+GATEWAY_TIMEOUT = timedelta(seconds=60)
+GATEWAY_CHECK_INTERVAL = timedelta(seconds=10)
+
+# Identical messages of a sid within the window are only counted as seen
+DEFAULT_DUPLICATE_WINDOW = timedelta(seconds=10)
+SID_PATTERN = re.compile(rb'"sid"\s*:\s*"(\w+)"')
+CMD_PATTERN = re.compile(rb'"cmd"\s*:\s*"(\w+)"')
+MODEL_PATTERN = re.compile(rb'"model"\s*:\s*"([\w.]+)"')
+# Proto 1 reports carry no sequence number, a repeated report of these
+# models is a new event (click, cube action, unlock, motion, alarm)
+EVENT_MODELS = frozenset(
+    model.encode()
+    for model in (
+        "motion", "sensor_motion", "sensor_motion.aq2",
+        "switch", "sensor_switch", "sensor_switch.aq2", "sensor_switch.aq3",
+        "remote.b1acn01",
+        "86sw1", "sensor_86sw1", "sensor_86sw1.aq1", "remote.b186acn01",
+        "86sw2", "sensor_86sw2", "sensor_86sw2.aq1", "remote.b286acn01",
+        "cube", "sensor_cube", "sensor_cube.aqgl01",
+        "smoke", "sensor_smoke",
+        "natgas", "sensor_natgas",
+        "vibration", "vibration.aq1",
+        "lock.aq1", "lock.acn02",
+    )
+)
+
+SIGNAL_NEW_DEVICE = f"{DOMAIN}_new_device"
+SIGNAL_REMOVE_DEVICE = f"{DOMAIN}_remove_device_{{}}"
+
+DEVICE_TYPES = {
+    "sensor": [
+        "sensor_ht", "gateway", "gateway.v3", "weather", "weather.v1",
+        "sensor_motion.aq2", "acpartner.v3", "vibration",
+    ],
+    "binary_sensor": [
+        "magnet", "sensor_magnet", "sensor_magnet.aq2",
+        "motion", "sensor_motion", "sensor_motion.aq2",
+        "switch", "sensor_switch", "sensor_switch.aq2", "sensor_switch.aq3",
+        "remote.b1acn01",
+        "86sw1", "sensor_86sw1", "sensor_86sw1.aq1", "remote.b186acn01",
+        "86sw2", "sensor_86sw2", "sensor_86sw2.aq1", "remote.b286acn01",
+        "cube", "sensor_cube", "sensor_cube.aqgl01",
+        "smoke", "sensor_smoke",
+        "natgas", "sensor_natgas",
+        "sensor_wleak.aq1",
+        "vibration", "vibration.aq1",
+    ],
+    "switch": [
+        "plug",
+        "ctrl_neutral1", "ctrl_neutral1.aq1",
+        "ctrl_neutral2", "ctrl_neutral2.aq1",
+        "ctrl_ln1", "ctrl_ln1.aq1",
+        "ctrl_ln2", "ctrl_ln2.aq1",
+        "86plug", "ctrl_86plug", "ctrl_86plug.aq1",
+    ],
+    "light": ["gateway", "gateway.v3"],
+    "cover": ["curtain", "curtain.aq2", "curtain.hagl04"],
+    "lock": ["lock.aq1", "lock.acn02"],
+}
+
 SERVICE_PLAY_RINGTONE = "play_ringtone"
 SERVICE_STOP_RINGTONE = "stop_ringtone"
 SERVICE_ADD_DEVICE = "add_device"
 SERVICE_REMOVE_DEVICE = "remove_device"
 SERVICE_RADIO_VOLUME = "radio_volume"
+SERVICE_BULK_SWITCH = "bulk_switch"
+
+EVENT_BULK_SWITCH = "xiaomi_aqara.bulk_switch"
 
 GW_MAC = vol.All(
     cv.string, lambda value: value.replace(":", "").lower(), vol.Length(min=12, max=12)
@@ -77,6 +201,20 @@ SERVICE_SCHEMA_RADIO_VOLUME = vol.Schema(
     {vol.Required(ATTR_RADIO_VOLUME): vol.All(cv.positive_int, vol.Range(min=0, max=100))}
 )
 
+SERVICE_SCHEMA_BULK_SWITCH = vol.All(
+    vol.Schema(
+        {
+            vol.Optional(ATTR_ENTITY_ID): cv.entity_ids,
+            vol.Optional(ATTR_SIDS): vol.All(
+                cv.ensure_list,
+                [vol.All(cv.string, lambda value: value.replace(":", "").lower())],
+            ),
+            vol.Required(ATTR_STATE): cv.boolean,
+        }
+    ),
+    cv.has_at_least_one_key(ATTR_ENTITY_ID, ATTR_SIDS),
+)
+
 GATEWAY_CONFIG = vol.Schema(
     {
         vol.Optional(CONF_KEY): vol.All(cv.string, vol.Length(min=16, max=16)),
@@ -109,6 +247,18 @@ def _fix_conf_defaults(config):
     return config
 
 
+def _validate_interfaces(interfaces):
+    """Reject "any" next to explicit interfaces and drop duplicates.
+
+    "any" joins the multicast group on the default interface, which is one
+    of the explicit ones, and a second join of it fails.
+    """
+    interfaces = list(dict.fromkeys(interfaces))
+    if "any" in interfaces and len(interfaces) > 1:
+        raise vol.Invalid('"any" cannot be combined with interface addresses')
+    return interfaces
+
+
 CONFIG_SCHEMA = vol.Schema(
     {
         DOMAIN: vol.Schema(
@@ -121,8 +271,13 @@ CONFIG_SCHEMA = vol.Schema(
                     ),
                     [_fix_conf_defaults],
                 ),
-                vol.Optional(CONF_INTERFACE, default="any"): cv.string,
+                vol.Optional(CONF_INTERFACE, default="any"): vol.All(
+                    cv.ensure_list, [cv.string], _validate_interfaces
+                ),
                 vol.Optional(CONF_DISCOVERY_RETRY, default=3): cv.positive_int,
+                vol.Optional(
+                    CONF_DUPLICATE_WINDOW, default=DEFAULT_DUPLICATE_WINDOW
+                ): cv.time_period,
             }
         )
     },
@@ -130,15 +285,17 @@ CONFIG_SCHEMA = vol.Schema(
 )
 
 
-def setup(hass, config):
+async def async_setup(hass, config):
     """Set up the Xiaomi component."""
     gateways = []
-    interface = "any"
+    interface = ["any"]
     discovery_retry = 3
+    duplicate_window = DEFAULT_DUPLICATE_WINDOW
     if DOMAIN in config:
         gateways = config[DOMAIN][CONF_GATEWAYS]
         interface = config[DOMAIN][CONF_INTERFACE]
         discovery_retry = config[DOMAIN][CONF_DISCOVERY_RETRY]
+        duplicate_window = config[DOMAIN][CONF_DUPLICATE_WINDOW]
 
     async def xiaomi_gw_discovered(service, discovery_info):
         """Perform action when Xiaomi Gateway device(s) has been found."""
@@ -146,37 +303,127 @@ def setup(hass, config):
         # discovery service is to just trigger loading of this
         # component, and then its own discovery process kicks in.
 
-    discovery.listen(hass, SERVICE_XIAOMI_GW, xiaomi_gw_discovered)
+    discovery.async_listen(hass, SERVICE_XIAOMI_GW, xiaomi_gw_discovered)
+
+    store = Store(hass, STORAGE_VERSION, STORAGE_KEY_DISCOVERY)
+    cached = await store.async_load()
+    inventory_store = Store(hass, STORAGE_VERSION, STORAGE_KEY_INVENTORY)
+    inventory = await inventory_store.async_load() or {}
 
     xiaomi = hass.data[PY_XIAOMI_GATEWAY] = XiaomiMiioGatewayDiscovery(
-        hass.add_job, gateways, interface
+        hass.add_job, gateways, interface, store=store,
+        inventory_store=inventory_store, inventory=inventory.get("gateways"),
     )
 
     _LOGGER.debug("Expecting %s gateways", len(gateways))
-    for k in range(discovery_retry):
-        _LOGGER.info("Discovering Xiaomi Gateways (Try %s)", k + 1)
-        xiaomi.discover_gateways()
-        if len(xiaomi.gateways) >= len(gateways):
-            break
+    if cached and await xiaomi.async_discover_from_cache(hass, cached):
+        _LOGGER.info("Xiaomi Gateways restored from discovery cache")
+        hass.async_create_task(xiaomi.async_rediscover(hass))
+    else:
+        for k in range(discovery_retry):
+            _LOGGER.info("Discovering Xiaomi Gateways (Try %s)", k + 1)
+            await xiaomi.async_discover_gateways(hass)
+            if len(xiaomi.gateways) >= len(gateways):
+                break
+
+        if xiaomi.gateways:
+            store.async_delay_save(xiaomi.discovery_cache, DISCOVERY_CACHE_SAVE_DELAY)
 
     if not xiaomi.gateways:
         _LOGGER.error("No gateway discovered")
         return
 
-    xiaomi.listen()
+    for gateway in xiaomi.gateways.values():
+        gateway.duplicate_window = duplicate_window.total_seconds()
+        gateway.timers = GatewayTimers(hass, TIME_TILL_UNAVAILABLE)
+        gateway.timers.async_start()
+        gateway.writer = GatewayWriter(hass, gateway)
+        if gateway.miio_client is not None:
+            gateway.miio_coordinator = GatewayMiioCoordinator(hass, gateway)
+
+    states = hass.data[DEVICE_STATES] = XiaomiDeviceStates(hass)
+    await states.async_load()
+
+    async def save_states(now):
+        """Write the device states in one batch."""
+        states.async_schedule_save()
+
+    async_track_time_interval(hass, save_states, STATE_SAVE_INTERVAL)
+
+    async def check_gateways(now):
+        """Flip the entities of lost and recovered gateways."""
+        gateways = list(xiaomi.gateways.values())
+        results = await asyncio.gather(
+            *(gateway.async_check_alive() for gateway in gateways),
+            return_exceptions=True,
+        )
+        for gateway, result in zip(gateways, results):
+            if isinstance(result, Exception):
+                _LOGGER.error(
+                    "Cannot check gateway %s: %s", gateway.sid, result,
+                    exc_info=result)
+
+    async_track_time_interval(hass, check_gateways, GATEWAY_CHECK_INTERVAL)
+
+    async def async_stop_xiaomi(event):
+        """Write the device states and close the MIIO sessions."""
+        await states.async_save()
+        for gateway in xiaomi.gateways.values():
+            gateway.timers.async_stop()
+            gateway.writer.close()
+            if gateway.miio_client is not None:
+                gateway.miio_queue.close()
+                gateway.miio_client.close()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop_xiaomi)
+
+    await xiaomi.async_listen(hass)
     _LOGGER.debug("Gateways discovered. Listening for broadcasts")
 
+    async def rediscover_gateways(now):
+        """Look for gateways which changed their address."""
+        await xiaomi.async_rediscover(hass)
+
+    async_track_time_interval(hass, rediscover_gateways, REDISCOVERY_INTERVAL)
+
+    async def discover_pending_devices(now):
+        """Retry sub-devices which did not answer during bring-up."""
+        await xiaomi.async_discover_pending(hass)
+
+    async_track_time_interval(
+        hass, discover_pending_devices, PENDING_DEVICES_INTERVAL
+    )
+
+    async def reconcile_inventory(event=None):
+        """Check the devices created from the inventory snapshot."""
+        await asyncio.gather(
+            *(
+                xiaomi.async_reconcile(hass, gateway)
+                for gateway in list(xiaomi.gateways.values())
+                if gateway.from_inventory
+            )
+        )
+
+    if hass.state == CoreState.running:
+        hass.async_create_task(reconcile_inventory())
+    else:
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START, reconcile_inventory)
+    xiaomi.save_inventory()
+
     for component in ["binary_sensor", "sensor", "switch", "light", "cover", "lock"]:
-        discovery.load_platform(hass, component, DOMAIN, {}, config)
+        hass.async_create_task(
+            discovery.async_load_platform(hass, component, DOMAIN, {}, config)
+        )
 
+    @callback
     def stop_xiaomi(event):
         """Stop Xiaomi Socket."""
         _LOGGER.info("Shutting down Xiaomi Hub")
         xiaomi.stop_listen()
 
-    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, stop_xiaomi)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, stop_xiaomi)
 
-    def play_ringtone_service(call):
+    async def play_ringtone_service(call):
         """Service to play ringtone through Gateway."""
         ring_id = call.data.get(ATTR_RINGTONE_ID)
         gateway = call.data.get(ATTR_GW_MAC)
@@ -187,12 +434,16 @@ def setup(hass, config):
         if ring_vol is not None:
             kwargs["vol"] = ring_vol
 
-        gateway.write_to_hub(gateway.sid, **kwargs)
+        await gateway.writer.async_write(gateway.sid, kwargs)
 
-    def stop_ringtone_service(call):
+    async def stop_ringtone_service(call):
         """Service to stop playing ringtone on Gateway."""
         gateway = call.data.get(ATTR_GW_MAC)
-        gateway.write_to_hub(gateway.sid, mid=10000)
+        # A ringtone still queued would start after the stop
+        gateway.writer.async_discard(gateway.sid, "mid")
+        await gateway.writer.async_write(
+            gateway.sid, {"mid": 10000}, WRITE_PRIORITY_SAFETY
+        )
 
     def add_device_service(call):
         """Service to add a new sub-device within the next 30 seconds."""
@@ -210,44 +461,121 @@ def setup(hass, config):
         gateway = call.data.get(ATTR_GW_MAC)
         gateway.write_to_hub(gateway.sid, remove_device=device_id)
 
-    def radio_volume_service(call):
-        """Service to remove a sub-device from the gateway."""
+    async def radio_volume_service(call):
+        """Service to set the radio volume of the gateway."""
         gateway = call.data.get(ATTR_GW_MAC)
         volume = call.data.get(ATTR_RADIO_VOLUME)
-        resp = gateway.miio.raw_command("volume_ctrl_fm", [f"{volume}"])
-        _LOGGER.debug(f"{gateway.sid} Radio Volume set to {resp.get('volume')}")
+        # Calls ramping the volume are collapsed into the latest one
+        params, resp = await gateway.miio_queue.async_send(
+            "volume_ctrl_fm", [f"{volume}"]
+        )
+        if "ok" not in resp:
+            _LOGGER.warning("%s: cannot set radio volume: %s", gateway.sid, resp)
+            return
+        applied = int(params[0])
+        coordinator = gateway.miio_coordinator
+        if coordinator.data.get("fm", {}).get("current_volume") != applied:
+            coordinator.async_set(
+                "fm", {**coordinator.data.get("fm", {}), "current_volume": applied}
+            )
+        _LOGGER.debug(f"{gateway.sid} Radio Volume set to {applied}")
+
+    async def bulk_switch_service(call):
+        """Service to switch plugs and wall switches of all gateways at once.
+
+        The writes of each gateway go through its write queue, where the
+        channels of a device are merged, and the gateways are written to
+        concurrently. Up to BULK_SWITCH_PARALLEL writes per gateway are
+        queued at once, so a call larger than the queue is not rejected.
+        The outcome per entity is fired as an event.
+        """
+        entity_ids = set(call.data.get(ATTR_ENTITY_ID, ()))
+        sids = set(call.data.get(ATTR_SIDS, ()))
+        state = call.data[ATTR_STATE]
+
+        groups = defaultdict(list)
+        found = set()
+        for gateway in xiaomi.gateways.values():
+            for entity in gateway.entities:
+                if not hasattr(entity, "async_set_state"):
+                    continue
+                sid = entity._sid  # pylint: disable=protected-access
+                if entity.entity_id in entity_ids or sid in sids:
+                    groups[gateway].append(entity)
+                    found.update((entity.entity_id, sid))
+        unknown = sorted((entity_ids | sids) - found)
+        if unknown:
+            _LOGGER.warning("bulk_switch: no switch found for %s", ", ".join(unknown))
+
+        async def async_switch_gateway(entities):
+            semaphore = asyncio.Semaphore(BULK_SWITCH_PARALLEL)
+
+            async def async_switch(entity):
+                async with semaphore:
+                    return await entity.async_set_state(state)
+
+            # The channels of a switch are queued together to be merged
+            entities.sort(
+                key=lambda entity: entity._sid  # pylint: disable=protected-access
+            )
+            results = await asyncio.gather(
+                *(async_switch(entity) for entity in entities)
+            )
+            return {
+                entity.entity_id: result for entity, result in zip(entities, results)
+            }
+
+        results = {}
+        for gateway_results in await asyncio.gather(
+            *(async_switch_gateway(entities) for entities in groups.values())
+        ):
+            results.update(gateway_results)
+        failed = sorted(entity_id for entity_id, ok in results.items() if not ok)
+        if failed:
+            _LOGGER.warning("bulk_switch: failed to switch %s", ", ".join(failed))
+        hass.bus.async_fire(
+            EVENT_BULK_SWITCH,
+            {ATTR_STATE: state, "results": results, "unknown": unknown},
+        )
 
     gateway_only_schema = _add_gateway_to_schema(xiaomi, vol.Schema({}))
 
-    hass.services.register(
+    hass.services.async_register(
         DOMAIN,
         SERVICE_PLAY_RINGTONE,
         play_ringtone_service,
         schema=_add_gateway_to_schema(xiaomi, SERVICE_SCHEMA_PLAY_RINGTONE),
     )
 
-    hass.services.register(
+    hass.services.async_register(
         DOMAIN, SERVICE_STOP_RINGTONE, stop_ringtone_service, schema=gateway_only_schema
     )
 
-    hass.services.register(
+    hass.services.async_register(
         DOMAIN, SERVICE_ADD_DEVICE, add_device_service, schema=gateway_only_schema
     )
 
-    hass.services.register(
+    hass.services.async_register(
         DOMAIN,
         SERVICE_REMOVE_DEVICE,
         remove_device_service,
         schema=_add_gateway_to_schema(xiaomi, SERVICE_SCHEMA_REMOVE_DEVICE),
     )
 
-    hass.services.register(
+    hass.services.async_register(
         DOMAIN,
         SERVICE_RADIO_VOLUME,
         radio_volume_service,
         schema=_add_gateway_to_schema(xiaomi, SERVICE_SCHEMA_RADIO_VOLUME),
     )
 
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_BULK_SWITCH,
+        bulk_switch_service,
+        schema=SERVICE_SCHEMA_BULK_SWITCH,
+    )
+
     return True
 
 
@@ -255,108 +583,1050 @@ class XiaomiMiioGatewayDiscovery(XiaomiGatewayDiscovery):
     """
     Proxy class, adding MIIO protocol to discovered devices.
     """
-    def discover_gateways(self):
-        """Discover gateways using multicast"""
+    def __init__(self, callback_func, gateways_config, interfaces, *args,
+                 store=None, inventory_store=None, inventory=None, **kwargs):
+        self._interfaces = cv.ensure_list(interfaces)
+        super().__init__(
+            callback_func, gateways_config, self._default_interface(),
+            *args, **kwargs
+        )
+        self._store = store
+        self._inventory_store = inventory_store
+        self._inventory = inventory or {}
+        self._mcast_transport = None
+
+    def _default_interface(self):
+        """Return the interface used when a gateway's own is unknown."""
+        if len(self._interfaces) == 1:
+            return self._interfaces[0]
+        return "any"
+
+    def _interface_for(self, ip_address):
+        """Return the configured interface the host routes an address over."""
+        if len(self._interfaces) == 1:
+            return self._interfaces[0]
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            try:
+                # Connecting a UDP socket only picks the route, nothing is sent
+                probe.connect((ip_address, self.GATEWAY_DISCOVERY_PORT))
+                local_address = probe.getsockname()[0]
+            except OSError:
+                return self._interface
+        if local_address in self._interfaces:
+            return local_address
+        return self._interface
+
+    def _config_for(self, sid):
+        """Return the configuration entry matching a discovered gateway sid."""
+        for gateway in self._gateways_config:
+            if gateway.get("sid") in (None, sid):
+                return gateway
+        return {}
+
+    def _is_disabled(self, sid):
+        """Return True if the gateway is disabled by configuration."""
+        config = self._config_for(sid)
+        return config.get("sid") == sid and bool(config.get("disable"))
+
+    def _expected_sids(self):
+        """Return the sids of all configured, enabled gateways."""
+        return {
+            gateway["sid"] for gateway in self._gateways_config
+            if gateway.get("sid") and not gateway.get("disable")
+        }
+
+    def _create_gateway(self, ip_add, port, sid, proto, model=None,
+                        interface=None, loop=None):
+        """Create a gateway, enumerating its devices (blocking)."""
+        config = self._config_for(sid)
+        return XiaomiMiioGateway(
+            ip_add, port, sid,
+            config.get("key"), self._device_discovery_retries,
+            interface or self._interface,
+            proto=proto,
+            miio_token=config.get("miio_token"),
+            model=model,
+            inventory=self._inventory.get(sid),
+            loop=loop,
+            )
 
-        _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        _socket.settimeout(5.0)
-        if self._interface != 'any':
-            _socket.bind((self._interface, 0))
+    def _gateway_for_sid(self, sid):
+        """Return the gateway a gateway or sub-device sid belongs to."""
+        for gateway in list(self.gateways.values()):
+            if gateway.sid == sid or sid in gateway.callbacks:
+                return gateway
+        return None
+
+    def inventory(self):
+        """Return the sub-devices of all gateways in their stored form."""
+        return {
+            "gateways": {
+                gateway.sid: gateway.inventory()
+                for gateway in self.gateways.values()
+            }
+        }
 
-        for gateway in self._gateways_config:
-            host = gateway.get('host')
-            port = gateway.get('port')
-            sid = gateway.get('sid')
+    @callback
+    def save_inventory(self):
+        """Schedule writing the device inventory snapshot."""
+        if self._inventory_store is not None:
+            self._inventory_store.async_delay_save(
+                self.inventory, INVENTORY_SAVE_DELAY
+            )
 
-            if not (host and port and sid):
+    async def async_discover_pending(self, hass):
+        """Retry sub-devices which did not answer during bring-up."""
+        now = time.monotonic()
+        for gateway in list(self.gateways.values()):
+            if not gateway.pending_sids or now < gateway.pending_retry_at:
                 continue
-            try:
-                ip_address = socket.gethostbyname(host)
-                if gateway.get('disable'):
-                    _LOGGER.info(
-                        'Xiaomi Gateway %s is disabled by configuration', sid)
-                    self.disabled_gateways.append(ip_address)
-                    continue
+            new_devices = await hass.async_add_executor_job(
+                gateway.discover_pending_devices
+            )
+            if new_devices:
+                gateway.pending_attempts = 0
+            else:
+                gateway.pending_attempts += 1
+            if gateway.pending_attempts >= PENDING_DEVICES_MAX_ATTEMPTS:
+                _LOGGER.warning(
+                    "Giving up on devices %s of gateway %s, they never answered",
+                    ", ".join(sorted(gateway.pending_sids)), gateway.sid)
+                gateway.pending_sids.clear()
+                gateway.pending_attempts = 0
+            delay = PENDING_DEVICES_INTERVAL.total_seconds()
+            gateway.pending_retry_at = now + delay * 2 ** gateway.pending_attempts
+            for device_type, device in new_devices:
+                async_dispatcher_send(
+                    hass, SIGNAL_NEW_DEVICE, gateway, device_type, device
+                )
+            if new_devices:
+                self.save_inventory()
+
+    async def async_reconcile(self, hass, gateway):
+        """Bring the devices created from a snapshot in line with the gateway.
+
+        Only the devices which were added or removed since the snapshot
+        have their entities created or removed.
+        """
+        added, removed, answers = await hass.async_add_executor_job(
+            gateway.reconcile_devices
+        )
+        for sid in removed:
+            _LOGGER.info("Device %s is no longer paired with %s", sid, gateway.sid)
+            async_dispatcher_send(hass, SIGNAL_REMOVE_DEVICE.format(sid))
+        for device_type, device in added:
+            async_dispatcher_send(
+                hass, SIGNAL_NEW_DEVICE, gateway, device_type, device
+            )
+        for resp in answers:
+            gateway.push_data(resp)
+        if added or removed:
+            self.save_inventory()
+
+    async def _async_create_gateways(self, hass, records):
+        """Bring up several gateways concurrently in the executor."""
+        semaphore = asyncio.Semaphore(MAX_PARALLEL_BRINGUP)
+
+        async def create(record):
+            async with semaphore:
+                return await hass.async_add_executor_job(
+                    self._create_gateway,
+                    record["ip"], record["port"], record["sid"], record["proto"],
+                    record.get("model"), record.get("interface"), hass.loop,
+                )
+
+        return await asyncio.gather(*(create(record) for record in records))
+
+    @callback
+    def _move_gateway(self, gateway, ip_add, port):
+        """Re-key a gateway whose address has changed.
+
+        A different gateway still keyed at the new address has moved too,
+        e.g. two gateways swapping their DHCP leases. It takes the freed
+        address until its own messages or a rediscovery show where it is,
+        so messages are never routed to the wrong gateway.
+        """
+        if (gateway.ip_adress, gateway.port) == (ip_add, int(port)):
+            return
+        _LOGGER.warning(
+            "Xiaomi Gateway %s moved from %s:%s to %s:%s",
+            gateway.sid, gateway.ip_adress, gateway.port, ip_add, port)
+        old_ip = gateway.ip_adress
+        if self.gateways.get(old_ip) is gateway:
+            del self.gateways[old_ip]
+        other = self.gateways.pop(ip_add, None)
+        gateway.update_address(ip_add, port)
+        self.gateways[ip_add] = gateway
+        if other is not None and other is not gateway:
+            _LOGGER.warning(
+                "Xiaomi Gateway %s is no longer at %s, assuming %s",
+                other.sid, ip_add, old_ip)
+            other.update_address(old_ip, other.port)
+            self.gateways[old_ip] = other
+        if self._store is not None:
+            self._store.async_delay_save(
+                self.discovery_cache, DISCOVERY_CACHE_SAVE_DELAY
+            )
+
+    def discovery_cache(self):
+        """Return the discovered gateways in their cached form."""
+        return {
+            "gateways": [
+                {
+                    "ip": gateway.ip_adress,
+                    "port": gateway.port,
+                    "sid": gateway.sid,
+                    "proto": gateway.proto,
+                    "model": gateway.model,
+                    "interface": gateway.interface,
+                }
+                for gateway in self.gateways.values()
+            ]
+        }
+
+    async def async_discover_from_cache(self, hass, cached):
+        """Create the gateways straight from a cached discovery result.
+
+        Returns False if the cache does not cover the configured gateways
+        or a cached gateway does not respond; a full discovery is needed
+        then.
+        """
+        records = {}
+        for record in cached.get("gateways", []):
+            if self._is_disabled(record["sid"]):
+                continue
+            interface = record.get("interface")
+            if interface not in self._interfaces:
+                # The configured interfaces or the host address changed
+                interface = self._interface_for(record["ip"])
+            records[record["sid"]] = dict(record, interface=interface)
+        if not records or not self._expected_sids() <= records.keys():
+            return False
+
+        answered = await asyncio.gather(
+            *(self._async_probe(hass.loop, record) for record in records.values())
+        )
+        for record, answer in zip(records.values(), answered):
+            if not answer:
                 _LOGGER.info(
-                    'Xiaomi Gateway %s configured at IP %s:%s',
-                    sid, ip_address, port)
-
-                self.gateways[ip_address] = XiaomiMiioGateway(
-                    ip_address, port, sid,
-                    gateway.get('key'), self._device_discovery_retries,
-                    self._interface,
-                    proto=gateway.get('proto'),
-                    miio_token=gateway.get("miio_token"),
-                    )
-            except OSError as error:
-                _LOGGER.error(
-                    "Could not resolve %s: %s", host, error)
+                    "Cached Xiaomi Gateway %s does not respond at %s",
+                    record["sid"], record["ip"])
+                return False
+
+        gateways = await self._async_create_gateways(hass, records.values())
+        for gateway in gateways:
+            self.gateways[gateway.ip_adress] = gateway
+        return True
+
+    async def _async_probe(self, loop, record):
+        """Return True if a cached gateway answers a read of itself."""
+        answered = loop.create_future()
+
+        def on_answer(resp, ip_add, interface):
+            if resp.get("sid") == record["sid"] and not answered.done():
+                answered.set_result(True)
 
+        interface = record["interface"]
+        try:
+            transport, _ = await loop.create_datagram_endpoint(
+                functools.partial(_WhoisProtocol, on_answer, interface),
+                sock=self._create_whois_socket(interface),
+            )
+        except OSError as err:
+            _LOGGER.debug("Cannot probe cached gateways on %s: %s", interface, err)
+            return False
         try:
-            _socket.sendto('{"cmd":"whois"}'.encode(),
-                           (self.MULTICAST_ADDRESS, self.GATEWAY_DISCOVERY_PORT))
+            transport.sendto(
+                json.dumps({"cmd": "read", "sid": record["sid"]}).encode(),
+                (record["ip"], int(record["port"])),
+            )
+            return await asyncio.wait_for(answered, CACHE_PROBE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            transport.close()
 
-            while True:
-                data, (ip_add, _) = _socket.recvfrom(1024)
-                if len(data) is None or ip_add in self.gateways:
-                    continue
+    async def async_rediscover(self, hass):
+        """Check the known gateways against a whois round.
 
-                if ip_add in self.gateways.keys() or ip_add in self.disabled_gateways:
-                    continue
+        Moved gateways are re-keyed in place, so their entities keep
+        working without being rebuilt.
+        """
+        answers = await self._async_whois(
+            hass.loop, {gateway.sid for gateway in self.gateways.values()}
+        )
 
-                resp = json.loads(data.decode())
-                if resp["cmd"] != 'iam':
-                    _LOGGER.error("Response does not match return cmd")
-                    continue
+        changed = False
+        for gateway in list(self.gateways.values()):
+            answer = answers.get(gateway.sid)
+            if answer is None:
+                _LOGGER.warning(
+                    "Xiaomi Gateway %s did not answer discovery", gateway.sid)
+                continue
+            self._move_gateway(gateway, answer["ip"], answer["port"])
+            if answer["proto"] is not None and answer["proto"] != gateway.proto:
+                gateway.proto = answer["proto"]
+                changed = True
+            if answer["model"] != gateway.model:
+                gateway.model = answer["model"]
+                changed = True
+
+        if changed and self._store is not None:
+            self._store.async_delay_save(
+                self.discovery_cache, DISCOVERY_CACHE_SAVE_DELAY
+            )
+
+    async def _async_resolve_configured(self, loop):
+        """Resolve the configured gateway hosts concurrently."""
+        configured = [
+            gateway for gateway in self._gateways_config
+            if gateway.get("host") and gateway.get("port") and gateway.get("sid")
+        ]
+        results = await asyncio.gather(
+            *(
+                loop.getaddrinfo(
+                    gateway["host"], gateway["port"],
+                    family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                for gateway in configured
+            ),
+            return_exceptions=True,
+        )
 
-                if resp["model"] not in GATEWAY_MODELS:
-                    _LOGGER.error("Response must be gateway model")
+        found = {}
+        for gateway, result in zip(configured, results):
+            sid = gateway["sid"]
+            if isinstance(result, OSError):
+                _LOGGER.error(
+                    "Could not resolve %s: %s", gateway["host"], result)
+                continue
+            ip_address = result[0][4][0]
+            if gateway.get("disable"):
+                _LOGGER.info(
+                    "Xiaomi Gateway %s is disabled by configuration", sid)
+                self.disabled_gateways.append(ip_address)
+                continue
+            _LOGGER.info(
+                "Xiaomi Gateway %s configured at IP %s:%s",
+                sid, ip_address, gateway["port"])
+            found[sid] = {
+                "ip": ip_address,
+                "port": gateway["port"],
+                "sid": sid,
+                "proto": gateway.get("proto"),
+                "model": None,
+                "interface": self._interface_for(ip_address),
+            }
+        return found
+
+    @staticmethod
+    def _create_whois_socket(interface):
+        """Create a socket sending whois requests out of one interface."""
+        _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _socket.setblocking(False)
+        if interface != "any":
+            _socket.bind((interface, 0))
+            _socket.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                socket.inet_aton(interface),
+            )
+        return _socket
+
+    async def _async_whois(self, loop, expected):
+        """Send a multicast whois on every interface and collect the iam
+        answers by sid.
+
+        Returns once every expected sid has answered. Otherwise waits for
+        a settle window after the last answer, scaled to the observed
+        round trip time, and never longer than DISCOVERY_TIMEOUT.
+        """
+        answers = {}
+        done = loop.create_future()
+        started = loop.time()
+        settle = None
+        settle_handle = None
+
+        def finish():
+            if not done.done():
+                done.set_result(None)
+
+        def on_answer(resp, ip_add, interface):
+            nonlocal settle, settle_handle
+            if resp.get("cmd") != "iam":
+                _LOGGER.error("Response does not match return cmd")
+                return
+            if resp.get("model") not in GATEWAY_MODELS:
+                _LOGGER.error("Response must be gateway model")
+                return
+            if "sid" not in resp or "port" not in resp:
+                _LOGGER.debug("Ignoring incomplete iam from %s: %s", ip_add, resp)
+                return
+
+            if resp["sid"] in answers:
+                return
+            answers[resp["sid"]] = {
+                "ip": ip_add,
+                "port": resp["port"],
+                "sid": resp["sid"],
+                "proto": resp.get("proto_version"),
+                "model": resp["model"],
+                "interface": interface,
+            }
+            if expected and expected <= answers.keys():
+                finish()
+                return
+
+            if settle is None:
+                settle = max(
+                    DISCOVERY_SETTLE_TIME,
+                    DISCOVERY_SETTLE_FACTOR * (loop.time() - started),
+                )
+            if settle_handle is not None:
+                settle_handle.cancel()
+            settle_handle = loop.call_later(settle, finish)
+
+        endpoints = await asyncio.gather(
+            *(
+                loop.create_datagram_endpoint(
+                    functools.partial(_WhoisProtocol, on_answer, interface),
+                    sock=self._create_whois_socket(interface),
+                )
+                for interface in self._interfaces
+            )
+        )
+        try:
+            for transport, _ in endpoints:
+                transport.sendto(
+                    b'{"cmd":"whois"}',
+                    (self.MULTICAST_ADDRESS, self.GATEWAY_DISCOVERY_PORT),
+                )
+            await asyncio.wait_for(done, DISCOVERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if settle_handle is not None:
+                settle_handle.cancel()
+            for transport, _ in endpoints:
+                transport.close()
+
+        _LOGGER.info(
+            "Gateway discovery finished in %.2f seconds", loop.time() - started
+        )
+        return answers
+
+    async def async_discover_gateways(self, hass):
+        """Discover gateways using multicast without blocking the event loop."""
+        found = await self._async_resolve_configured(hass.loop)
+
+        expected = self._expected_sids()
+        known = {gateway.sid for gateway in self.gateways.values()}
+        if not expected or not expected <= known | found.keys():
+            answers = await self._async_whois(hass.loop, expected - found.keys())
+            for sid, answer in answers.items():
+                if sid in found or sid in known:
+                    continue
+                if answer["ip"] in self.disabled_gateways:
                     continue
+                if self._is_disabled(sid):
+                    _LOGGER.info(
+                        "Xiaomi Gateway %s is disabled by configuration", sid)
+                    self.disabled_gateways.append(answer["ip"])
+                    continue
+                _LOGGER.info("Xiaomi Gateway %s found at IP %s", sid, answer["ip"])
+                found[sid] = answer
+
+        records = [
+            record for sid, record in found.items()
+            if sid not in known and record["ip"] not in self.gateways
+        ]
+        for gateway in await self._async_create_gateways(hass, records):
+            self.gateways[gateway.ip_adress] = gateway
+
+    def _create_mcast_socket(self):
+        """Create one multicast socket joined on every configured interface."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if platform.system() != "Windows":
+            sock.bind((self.MULTICAST_ADDRESS, self.MULTICAST_PORT))
+        elif self._interface != "any":
+            sock.bind((self._interface, self.MULTICAST_PORT))
+        else:
+            sock.bind(("", self.MULTICAST_PORT))
+
+        for interface in self._interfaces:
+            if interface == "any":
+                mreq = struct.pack(
+                    "=4sl", socket.inet_aton(self.MULTICAST_ADDRESS),
+                    socket.INADDR_ANY)
+            else:
+                mreq = socket.inet_aton(self.MULTICAST_ADDRESS) + \
+                    socket.inet_aton(interface)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        return sock
+
+    async def async_listen(self, hass):
+        """Start receiving multicast messages on the event loop."""
+        _LOGGER.info("Creating Multicast Socket")
+        sock = self._create_mcast_socket()
+        sock.setblocking(False)
+        self._mcast_transport, _ = await hass.loop.create_datagram_endpoint(
+            lambda: _MulticastProtocol(self._async_handle_message), sock=sock
+        )
+        self._listening = True
 
-                disabled = False
-                gateway_key = None
-                for gateway in self._gateways_config:
-                    sid = gateway.get('sid')
-                    if sid is None or sid == resp["sid"]:
-                        gateway_key = gateway.get('key')
-                    if sid and sid == resp['sid'] and gateway.get('disable'):
-                        disabled = True
-
-                sid = resp["sid"]
-                if disabled:
-                    _LOGGER.info("Xiaomi Gateway %s is disabled by configuration",
-                                 sid)
-                    self.disabled_gateways.append(ip_add)
-                else:
-                    _LOGGER.info('Xiaomi Gateway %s found at IP %s', sid, ip_add)
-                    self.gateways[ip_add] = XiaomiMiioGateway(
-                        ip_add, resp["port"], sid, gateway_key,
-                        self._device_discovery_retries, self._interface,
-                        proto=resp["proto_version"] if "proto_version" in resp else None,
-                        miio_token=gateway.get("miio_token"),
-                        )
-
-        except socket.timeout:
-            _LOGGER.info("Gateway discovery finished in 5 seconds")
-            _socket.close()
+    @callback
+    def stop_listen(self):
+        """Stop receiving multicast messages."""
+        self._listening = False
+        if self._mcast_transport is not None:
+            _LOGGER.info("Closing multisocket")
+            self._mcast_transport.close()
+            self._mcast_transport = None
+
+    @callback
+    def _async_handle_message(self, data, ip_add):
+        """Dispatch a multicast message, following gateways which move."""
+        gateway = self.gateways.get(ip_add)
+        if gateway is not None:
+            match = SID_PATTERN.search(data)
+            sid = match.group(1).decode() if match else gateway.sid
+            if sid != gateway.sid and sid not in gateway.callbacks:
+                owner = self._gateway_for_sid(sid)
+                if owner is not None:
+                    # Another gateway sends from this address, they swapped
+                    self._move_gateway(owner, ip_add, owner.port)
+                    gateway = owner
+            gateway.async_mark_alive()
+            if gateway.writer is not None:
+                gateway.writer.async_message_received(data)
+            if gateway.async_is_duplicate(data):
+                return
+        try:
+            data = json.loads(data.decode("ascii"))
+            cmd = data["cmd"]
+            if gateway is None:
+                gateway = self._gateway_for_sid(data.get("sid"))
+                if gateway is None:
+                    _LOGGER.error("Unknown gateway ip %s", ip_add)
+                    return
+                self._move_gateway(gateway, ip_add, gateway.port)
+                gateway.async_mark_alive()
+
+            if cmd == "heartbeat" and data["model"] in GATEWAY_MODELS:
+                gateway.token = data["token"]
+            elif cmd in ("report", "heartbeat"):
+                _LOGGER.debug("MCAST (%s) << %s", cmd, data)
+                gateway.push_data(data)
+            else:
+                _LOGGER.error("Unknown multicast data: %s", data)
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Cannot process multicast message: %s", data)
+
+
+class _MulticastProtocol(asyncio.DatagramProtocol):
+    """Pass the multicast messages of the gateways to a callback."""
+
+    def __init__(self, on_message):
+        """Initialize the protocol."""
+        self._on_message = on_message
+
+    def datagram_received(self, data, addr):
+        """Hand a datagram over, on the event loop."""
+        self._on_message(data, addr[0])
+
+    def error_received(self, exc):
+        """Log socket errors."""
+        _LOGGER.debug("Multicast socket error: %s", exc)
+
+
+class _WhoisProtocol(asyncio.DatagramProtocol):
+    """Pass iam answers to a multicast whois to a callback."""
+
+    def __init__(self, on_answer, interface):
+        """Initialize the protocol."""
+        self._on_answer = on_answer
+        self._interface = interface
+
+    def datagram_received(self, data, addr):
+        """Decode an answer and hand it over."""
+        try:
+            resp = json.loads(data.decode())
+        except ValueError:
+            _LOGGER.error("Cannot decode discovery response from %s", addr[0])
+            return
+        if not isinstance(resp, dict):
+            _LOGGER.debug("Ignoring discovery response from %s: %s", addr[0], resp)
+            return
+        self._on_answer(resp, addr[0], self._interface)
 
 
 class XiaomiMiioGateway(XiaomiGateway):
     """
     update Gateway with MIIO calls
     """
-    def __init__(self, *args, miio_token=None, **kwargs):
+    def __init__(self, *args, miio_token=None, model=None, inventory=None,
+                 loop=None, **kwargs):
         self.miio_token = miio_token
-        self.miio = None
+        self.miio_client = None
+        self.miio_queue = None
+        self.miio_coordinator = None
+        self.model = model
+        self.pending_sids = set()
+        self.pending_attempts = 0
+        self.pending_retry_at = 0
+        self.from_inventory = False
+        self._snapshot = inventory
+        self.loop = loop
+        self.duplicate_window = DEFAULT_DUPLICATE_WINDOW.total_seconds()
+        self.touch_callbacks = defaultdict(list)
+        self.timers = None
+        self.writer = None
+        self.stats = Counter()
+        self.available = True
+        self.entities = set()
+        self._last_alive = time.monotonic()
+        self._key_cache = None
+        self._last_messages = {}
         if miio_token:
-            self.miio = miio.device.Device(args[0], miio_token)
+            self.miio_client = AsyncMiioClient(args[0], miio_token)
+            self.miio_queue = MiioCommandQueue(self._async_send_miio)
         _LOGGER.debug(f"MIIO init with IP {args[0]} and token {miio_token}.")
         super().__init__(*args, **kwargs)
 
+    @property
+    def interface(self):
+        """Return the interface the gateway is reached through."""
+        return self._interface
+
+    def update_address(self, ip_adress, port):
+        """Point the gateway and its MIIO device to a new address."""
+        self.ip_adress = ip_adress
+        self.port = int(port)
+        if self.miio_token:
+            self.miio_client.close()
+            self.miio_client = AsyncMiioClient(ip_adress, self.miio_token)
+
+    async def _async_send_miio(self, method, params):
+        """Send a MIIO command through the current client."""
+        return await self.miio_client.async_send(method, params)
+
+    def get_from_hub(self, sid):
+        """Read a device, its answer is pushed on the event loop (blocking)."""
+        cmd = '{ "cmd":"read","sid":"' + sid + '"}'
+        if int(self.proto[0:1]) == 1:
+            resp = self._send_cmd(cmd, "read_ack")
+        else:
+            resp = self._send_cmd(cmd, "read_rsp")
+        _LOGGER.debug("read_ack << %s", resp)
+        if resp is None:
+            return False
+        self.loop.call_soon_threadsafe(self.push_data, resp)
+        return True
+
+    def _get_key(self):
+        """Return the write key, derived once per token."""
+        if self._key_cache is None or self._key_cache[0] != self.token:
+            self._key_cache = (self.token, super()._get_key())
+        return self._key_cache[1]
+
+    @callback
+    def async_mark_alive(self):
+        """Record a message of the gateway, recovering a lost gateway."""
+        self._last_alive = time.monotonic()
+        if not self.available:
+            self._async_set_available(True)
+
+    async def async_check_alive(self):
+        """Mark the gateway lost when it is silent and MIIO does not answer.
+
+        Multicast may be dropped by the network while the gateway is fine,
+        so a gateway with a MIIO token is only lost once it does not answer
+        MIIO either.
+        """
+        silent = time.monotonic() - self._last_alive
+        if silent < GATEWAY_TIMEOUT.total_seconds():
+            return
+        reachable = False
+        if self.miio_client is not None:
+            try:
+                await self.miio_queue.async_send("miIO.info")
+                reachable = True
+            except (DeviceException, OSError) as err:
+                _LOGGER.debug("Gateway %s: MIIO unreachable: %s", self.sid, err)
+        if reachable != self.available:
+            self._async_set_available(reachable)
+
+    @callback
+    def _async_set_available(self, available):
+        """Write the entities whose availability flips, in one callback.
+
+        Entities of devices which timed out on their own stay unavailable
+        and are not written again.
+        """
+        was_available = {entity: entity.available for entity in self.entities}
+        self.available = available
+        if available:
+            _LOGGER.info("Xiaomi Gateway %s is back", self.sid)
+        else:
+            _LOGGER.warning(
+                "Xiaomi Gateway %s is lost, %s entities unavailable",
+                self.sid, sum(was_available.values()))
+        for entity, was in was_available.items():
+            if entity.available != was:
+                entity.async_write_ha_state()
+
+    @callback
+    def async_is_duplicate(self, message):
+        """Return True if a raw message repeats the last one of its sid.
+
+        Only messages within the window of the last accepted one are
+        dropped, the device is still recorded as seen. Reports of
+        EVENT_MODELS are never dropped, heartbeats always may be.
+        """
+        self.stats["received"] += 1
+        if not self.duplicate_window:
+            return False
+        match = SID_PATTERN.search(message)
+        if match is None:
+            return False
+        cmd = CMD_PATTERN.search(message)
+        if cmd is None or cmd.group(1) != b"heartbeat":
+            model = MODEL_PATTERN.search(message)
+            if model is None or model.group(1) in EVENT_MODELS:
+                return False
+        sid = match.group(1).decode()
+        now = time.monotonic()
+        last = self._last_messages.get(sid)
+        if (
+            last is not None
+            and last[0] == message
+            and now - last[1] < self.duplicate_window
+        ):
+            self.stats["duplicates"] += 1
+            for func in self.touch_callbacks.get(sid, ()):
+                func()
+            return True
+        self._last_messages[sid] = (message, now)
+        return False
+
+    @callback
+    def push_data(self, data):
+        """Decode a message once and hand it to the entities of its device.
+
+        The battery values are computed here once for all the entities.
+        """
+        try:
+            if int(self.proto[0:1]) == 1:
+                jdata = json.loads(data["data"])
+            else:
+                jdata = _list2map(data["params"])
+        except KeyError:
+            _LOGGER.error("No data in response from hub %s", data)
+            return False
+        if jdata is None:
+            return False
+        if "error" in jdata:
+            _LOGGER.error("Got error element in data %s", data)
+            return False
+
+        battery = parse_battery(jdata)
+        for func in self.callbacks.get(data["sid"], ()):
+            func(jdata, data, battery)
+        return True
+
+    def _get_device_sids(self):
+        """Fetch the sids of the sub-devices and of the gateway itself."""
+        if int(self.proto[0:1]) == 1:
+            resp = self._send_cmd('{"cmd" : "get_id_list"}', "get_id_list_ack")
+            if not _validate_data(resp):
+                _LOGGER.error("Got bad response from gateway: %s", resp)
+                return None
+            sids = json.loads(resp["data"])
+        else:
+            resp = self._send_cmd('{"cmd":"discovery"}', "discovery_rsp")
+            if resp is None or "dev_list" not in resp:
+                _LOGGER.error("Got bad response from gateway: %s", resp)
+                return None
+            sids = [device["sid"] for device in resp["dev_list"]]
+        if "token" in resp:
+            self.token = resp["token"]
+        sids.append(self.sid)
+        _LOGGER.info("Found %s devices", len(sids))
+        return sids
+
+    def _discover_devices(self):
+        """Enumerate the sub-devices with several reads in flight.
+
+        Sub-devices which do not answer are left in pending_sids and
+        picked up later by discover_pending_devices. With an inventory
+        snapshot the devices are taken from it, only the device list is
+        fetched for the write token, and reconcile_devices checks them
+        later.
+        """
+        if self._snapshot:
+            self._load_inventory(self._snapshot)
+            self._snapshot = None
+            self.from_inventory = True
+            # Only for the write token, reconcile_devices checks the list
+            self._get_device_sids()
+            return True
+
+        sids = self._get_device_sids()
+        if sids is None:
+            return False
+
+        answers = self._read_devices(sids)
+        for sid in sids:
+            resp = answers.get(sid)
+            if resp is None:
+                _LOGGER.warning(
+                    "Device %s did not answer, it will be added later", sid)
+                self.pending_sids.add(sid)
+                continue
+            self._register_device(resp)
+        return True
+
+    def inventory(self):
+        """Return the sub-devices in their stored form."""
+        return {
+            device_type: [
+                {
+                    "model": device["model"],
+                    "proto": device["proto"],
+                    "sid": device["sid"],
+                    "short_id": device["short_id"],
+                }
+                for device in devices
+            ]
+            for device_type, devices in self.devices.items()
+        }
+
+    def _load_inventory(self, inventory):
+        """Fill the devices map from a stored inventory."""
+        for device_type, devices in inventory.items():
+            for device in devices:
+                self.devices[device_type].append({
+                    **device,
+                    "data": {},
+                    "raw_data": {
+                        "cmd": "read_ack",
+                        "model": device["model"],
+                        "sid": device["sid"],
+                    },
+                })
+        _LOGGER.info(
+            "Loaded %s devices of gateway %s from inventory",
+            sum(len(devices) for devices in self.devices.values()), self.sid)
+
+    def reconcile_devices(self):
+        """Compare the devices map with the gateway's device list (blocking).
+
+        Returns the (device_type, device) pairs which are new, the sids
+        which are gone and the read answers of the devices already known.
+        """
+        sids = self._get_device_sids()
+        if sids is None:
+            _LOGGER.error("Cannot reconcile devices of gateway %s", self.sid)
+            return [], [], []
+        self.from_inventory = False
+
+        known = {
+            device["sid"] for devices in self.devices.values() for device in devices
+        }
+        listed = {sid.rjust(12, "0"): sid for sid in sids}
+        removed = known - listed.keys()
+        for device_type, devices in self.devices.items():
+            self.devices[device_type] = [
+                device for device in devices if device["sid"] not in removed
+            ]
+
+        answers = self._read_devices(list(listed.values()))
+        added = []
+        updates = []
+        for sid, resp in answers.items():
+            if sid.rjust(12, "0") in known:
+                updates.append(resp)
+            else:
+                added.extend(self._register_device(resp))
+        self.pending_sids = {
+            sid for key, sid in listed.items()
+            if sid not in answers and key not in known
+        }
+        self.pending_attempts = 0
+        self.pending_retry_at = 0
+        return added, sorted(removed), updates
+
+    def discover_pending_devices(self):
+        """Read the pending sub-devices again (blocking).
+
+        Returns (device_type, device) pairs for the devices which answered.
+        """
+        answers = self._read_devices(sorted(self.pending_sids))
+        new_devices = []
+        for sid, resp in answers.items():
+            self.pending_sids.discard(sid)
+            new_devices.extend(self._register_device(resp))
+        return new_devices
+
+    def _read_devices(self, sids):
+        """Read several sids over one socket, matching answers by sid."""
+        rtn_cmd = "read_ack" if int(self.proto[0:1]) == 1 else "read_rsp"
+        answers = {}
+
+        _socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            if self._interface != "any":
+                _socket.bind((self._interface, 0))
+
+            for retry in range(self._discovery_retries):
+                queue = [sid for sid in sids if sid not in answers]
+                if not queue:
+                    break
+                _LOGGER.debug(
+                    "Reading %d devices, attempt %d/%d",
+                    len(queue), retry + 1, self._discovery_retries)
+
+                in_flight = {}
+                while queue or in_flight:
+                    while queue and len(in_flight) < ENUMERATION_WINDOW:
+                        sid = queue.pop(0)
+                        cmd = '{"cmd":"read","sid":"' + sid + '"}'
+                        _socket.sendto(cmd.encode(), (self.ip_adress, self.port))
+                        in_flight[sid] = time.monotonic() + ENUMERATION_TIMEOUT
+
+                    now = time.monotonic()
+                    for sid, deadline in list(in_flight.items()):
+                        if deadline <= now:
+                            del in_flight[sid]
+                    if not in_flight:
+                        continue
+
+                    _socket.settimeout(min(in_flight.values()) - now)
+                    try:
+                        data, _ = _socket.recvfrom(1024)
+                        resp = json.loads(data.decode())
+                    except socket.timeout:
+                        continue
+                    except ValueError:
+                        _LOGGER.error("Cannot decode read response: %s", data)
+                        continue
+
+                    sid = resp.get("sid")
+                    if resp.get("cmd") != rtn_cmd or sid not in in_flight:
+                        continue
+                    del in_flight[sid]
+                    if _validate_data(resp):
+                        answers[sid] = resp
+        except OSError as error:
+            _LOGGER.error("Cannot read devices of gateway %s: %s", self.sid, error)
+        finally:
+            _socket.close()
+        return answers
+
+    def _register_device(self, resp):
+        """Add a read answer to the devices map."""
+        model = resp["model"]
+        registered = []
+        for device_type, models in DEVICE_TYPES.items():
+            if model not in models:
+                continue
+            xiaomi_device = {
+                "model": model,
+                "proto": self.proto,
+                "sid": resp["sid"].rjust(12, "0"),
+                "short_id": resp["short_id"] if "short_id" in resp else 0,
+                "data": _list2map(_get_value(resp)),
+                "raw_data": resp,
+            }
+            self.devices[device_type].append(xiaomi_device)
+            registered.append((device_type, xiaomi_device))
+            _LOGGER.debug(
+                "Registering device %s, %s as: %s", resp["sid"], model, device_type)
+
+        if not registered:
+            _LOGGER.error(
+                "Unsupported device found! Please create an issue at "
+                "https://github.com/Danielhiversen/PyXiaomiGateway/issues "
+                "and provide the following data: %s", resp)
+        return registered
+
+
+class XiaomiDeviceStates:
+    """Keep the last state of the Xiaomi devices across restarts.
+
+    Entities register themselves and are only read when the store is
+    written, periodically and on shutdown, never on each update.
+    """
+
+    def __init__(self, hass):
+        """Initialize the states store."""
+        self._store = Store(hass, STORAGE_VERSION, STORAGE_KEY_STATES)
+        self._entities = {}
+        self.restored = {}
+
+    async def async_load(self):
+        """Load the states saved by the previous run."""
+        self.restored = await self._store.async_load() or {}
+
+    @callback
+    def register(self, entity):
+        """Include an entity in the saved states."""
+        self._entities[entity.unique_id] = entity
+
+    @callback
+    def unregister(self, entity):
+        """Drop an entity from the saved states."""
+        self._entities.pop(entity.unique_id, None)
+        self.restored.pop(entity.unique_id, None)
+
+    def _data_to_save(self):
+        """Collect the states of all registered entities."""
+        data = dict(self.restored)
+        for unique_id, entity in self._entities.items():
+            data[unique_id] = entity.persisted_state()
+        return data
+
+    @callback
+    def async_schedule_save(self):
+        """Schedule writing the states."""
+        self._store.async_delay_save(self._data_to_save, 0)
+
+    async def async_save(self):
+        """Write the states now."""
+        await self._store.async_save(self._data_to_save())
+
+
+def parse_battery(data):
+    """Return the voltage and battery level attributes of a message."""
+    if "voltage" in data:
+        voltage = data["voltage"]
+    elif "battery_voltage" in data:
+        voltage = data["battery_voltage"]
+    else:
+        return None
+
+    max_volt = 3300
+    min_volt = 2800
+    level = min(max(voltage, min_volt), max_volt)
+    percent = ((level - min_volt) / (max_volt - min_volt)) * 100
+    return {
+        ATTR_VOLTAGE: round(voltage / 1000.0, 2),
+        ATTR_BATTERY_LEVEL: round(percent, 1),
+    }
+
 
 class XiaomiDevice(Entity):
     """Representation a base Xiaomi device."""
 
+    # Attributes saved across restarts, see XiaomiDeviceStates
+    _persisted_attributes = ("_state",)
+
+    # Data keys parse_data reads besides _data_key, None to get all keys
+    _parsed_keys = None
+
+    # Queue of the gateway writer the writes of the entity go to
+    _write_priority = WRITE_PRIORITY_NORMAL
+
     def __init__(self, device, device_type, xiaomi_hub):
         """Initialize the Xiaomi device."""
         self._state = None
@@ -364,14 +1634,20 @@ class XiaomiDevice(Entity):
         self._sid = device["sid"]
         self._name = f"{device_type}_{self._sid}"
         self._type = device_type
-        self._write_to_hub = xiaomi_hub.write_to_hub
         self._get_from_hub = xiaomi_hub.get_from_hub
         self._device_state_attributes = {}
-        self._remove_unavailability_tracker = None
+        self._remove_signal_listener = None
         self._xiaomi_hub = xiaomi_hub
         self.parse_data(device["data"], device["raw_data"])
         self.parse_voltage(device["data"])
 
+        if self._parsed_keys is None:
+            self._push_keys = None
+        else:
+            self._push_keys = frozenset(self._parsed_keys)
+            if getattr(self, "_data_key", None):
+                self._push_keys |= {self._data_key}  # pylint: disable=no-member
+
         if hasattr(self, "_data_key") and self._data_key:  # pylint: disable=no-member
             self._unique_id = "{}{}".format(
                 self._data_key, self._sid  # pylint: disable=no-member
@@ -379,13 +1655,62 @@ class XiaomiDevice(Entity):
         else:
             self._unique_id = f"{self._type}{self._sid}"
 
-    def _add_push_data_job(self, *args):
-        self.hass.add_job(self.push_data, *args)
+    def persisted_state(self):
+        """Return the state to save across restarts."""
+        return {
+            "state": {
+                attr: getattr(self, attr)
+                for attr in self._persisted_attributes
+                if getattr(self, attr) is not None
+            },
+            "attributes": self._device_state_attributes,
+        }
+
+    @callback
+    def _async_restore_state(self):
+        """Restore the saved state where no data was received yet."""
+        states = self.hass.data[DEVICE_STATES]
+        restored = states.restored.get(self.unique_id)
+        if restored:
+            for attr, value in restored["state"].items():
+                if attr in self._persisted_attributes and getattr(self, attr) is None:
+                    setattr(self, attr, value)
+            for key, value in restored["attributes"].items():
+                self._device_state_attributes.setdefault(key, value)
+        states.register(self)
 
     async def async_added_to_hass(self):
         """Start unavailability tracking."""
-        self._xiaomi_hub.callbacks[self._sid].append(self._add_push_data_job)
+        self._async_restore_state()
+        self._xiaomi_hub.callbacks[self._sid].append(self.push_data)
+        self._xiaomi_hub.touch_callbacks[self._sid].append(self._async_touch)
+        self._xiaomi_hub.entities.add(self)
         self._async_track_unavailable()
+        self._remove_signal_listener = async_dispatcher_connect(
+            self.hass,
+            SIGNAL_REMOVE_DEVICE.format(self._sid),
+            self._async_device_removed,
+        )
+
+    async def async_will_remove_from_hass(self):
+        """Stop receiving data from the gateway."""
+        callbacks = self._xiaomi_hub.callbacks[self._sid]
+        if self.push_data in callbacks:
+            callbacks.remove(self.push_data)
+        touch_callbacks = self._xiaomi_hub.touch_callbacks[self._sid]
+        if self._async_touch in touch_callbacks:
+            touch_callbacks.remove(self._async_touch)
+        self._xiaomi_hub.timers.async_forget(self)
+        self._xiaomi_hub.entities.discard(self)
+        if self._remove_signal_listener:
+            self._remove_signal_listener()
+            self._remove_signal_listener = None
+        self.hass.data[DEVICE_STATES].unregister(self)
+
+    @callback
+    def _async_device_removed(self):
+        """Remove the entity when its device left the gateway."""
+        self.hass.async_create_task(self.async_remove())
 
     @property
     def name(self):
@@ -399,8 +1724,8 @@ class XiaomiDevice(Entity):
 
     @property
     def available(self):
-        """Return True if entity is available."""
-        return self._is_available
+        """Return True if entity and gateway are available."""
+        return self._is_available and self._xiaomi_hub.available
 
     @property
     def should_poll(self):
@@ -413,51 +1738,52 @@ class XiaomiDevice(Entity):
         return self._device_state_attributes
 
     @callback
-    def _async_set_unavailable(self, now):
-        """Set state to UNAVAILABLE."""
-        self._remove_unavailability_tracker = None
+    def async_set_unavailable(self, now):
+        """Set state to UNAVAILABLE, called by the gateway timers."""
         self._is_available = False
         self.async_schedule_update_ha_state()
 
     @callback
     def _async_track_unavailable(self):
-        if self._remove_unavailability_tracker:
-            self._remove_unavailability_tracker()
-        self._remove_unavailability_tracker = async_track_point_in_utc_time(
-            self.hass, self._async_set_unavailable, utcnow() + TIME_TILL_UNAVAILABLE
-        )
+        """Record the device as seen, returns True if it was unavailable."""
+        self._xiaomi_hub.timers.async_seen(self)
         if not self._is_available:
             self._is_available = True
             return True
         return False
 
     @callback
-    def push_data(self, data, raw_data):
-        """Push from Hub."""
+    def _async_touch(self):
+        """Record a repeated message, which only proves the device alive."""
+        if self._async_track_unavailable():
+            self.async_schedule_update_ha_state()
+
+    @callback
+    def push_data(self, data, raw_data, battery=None):
+        """Push from Hub, the gateway decoded the data and battery values."""
         _LOGGER.debug("PUSH >> %s: %s", self, data)
         was_unavailable = self._async_track_unavailable()
-        is_data = self.parse_data(data, raw_data)
-        is_voltage = self.parse_voltage(data)
+        if self._push_keys is not None:
+            data = {key: data[key] for key in self._push_keys.intersection(data)}
+        is_data = bool(data) and self.parse_data(data, raw_data)
+        is_voltage = battery is not None
+        if is_voltage:
+            self._device_state_attributes.update(battery)
         if is_data or is_voltage or was_unavailable:
             self.async_schedule_update_ha_state()
 
+    async def _async_write_to_hub(self, sid, **data):
+        """Write to the device through the gateway's write queue."""
+        return await self._xiaomi_hub.writer.async_write(
+            sid, data, self._write_priority
+        )
+
     def parse_voltage(self, data):
         """Parse battery level data sent by gateway."""
-        if "voltage" in data:
-            voltage_key = "voltage"
-        elif "battery_voltage" in data:
-            voltage_key = "battery_voltage"
-        else:
+        battery = parse_battery(data)
+        if battery is None:
             return False
-
-        max_volt = 3300
-        min_volt = 2800
-        voltage = data[voltage_key]
-        self._device_state_attributes[ATTR_VOLTAGE] = round(voltage / 1000.0, 2)
-        voltage = min(voltage, max_volt)
-        voltage = max(voltage, min_volt)
-        percent = ((voltage - min_volt) / (max_volt - min_volt)) * 100
-        self._device_state_attributes[ATTR_BATTERY_LEVEL] = round(percent, 1)
+        self._device_state_attributes.update(battery)
         return True
 
     def parse_data(self, data, raw_data):
@@ -3,9 +3,9 @@ import logging
 
 from homeassistant.components.binary_sensor import BinarySensorDevice
 from homeassistant.core import callback
-from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.dispatcher import dispatcher_connect
 
-from . import PY_XIAOMI_GATEWAY, XiaomiDevice
+from . import PY_XIAOMI_GATEWAY, SIGNAL_NEW_DEVICE, XiaomiDevice
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -26,78 +26,84 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     devices = []
     for (_, gateway) in hass.data[PY_XIAOMI_GATEWAY].gateways.items():
         for device in gateway.devices["binary_sensor"]:
-            model = device["model"]
-            if model in ["motion", "sensor_motion", "sensor_motion.aq2"]:
-                devices.append(XiaomiMotionSensor(device, hass, gateway))
-            elif model in ["magnet", "sensor_magnet", "sensor_magnet.aq2"]:
-                devices.append(XiaomiDoorSensor(device, gateway))
-            elif model == "sensor_wleak.aq1":
-                devices.append(XiaomiWaterLeakSensor(device, gateway))
-            elif model in ["smoke", "sensor_smoke"]:
-                devices.append(XiaomiSmokeSensor(device, gateway))
-            elif model in ["natgas", "sensor_natgas"]:
-                devices.append(XiaomiNatgasSensor(device, gateway))
-            elif model in [
-                "switch",
-                "sensor_switch",
-                "sensor_switch.aq2",
-                "sensor_switch.aq3",
-                "remote.b1acn01",
-            ]:
-                if "proto" not in device or int(device["proto"][0:1]) == 1:
-                    data_key = "status"
-                else:
-                    data_key = "button_0"
-                devices.append(XiaomiButton(device, "Switch", data_key, hass, gateway))
-            elif model in [
-                "86sw1",
-                "sensor_86sw1",
-                "sensor_86sw1.aq1",
-                "remote.b186acn01",
-            ]:
-                if "proto" not in device or int(device["proto"][0:1]) == 1:
-                    data_key = "channel_0"
-                else:
-                    data_key = "button_0"
-                devices.append(
-                    XiaomiButton(device, "Wall Switch", data_key, hass, gateway)
-                )
-            elif model in [
-                "86sw2",
-                "sensor_86sw2",
-                "sensor_86sw2.aq1",
-                "remote.b286acn01",
-            ]:
-                if "proto" not in device or int(device["proto"][0:1]) == 1:
-                    data_key_left = "channel_0"
-                    data_key_right = "channel_1"
-                else:
-                    data_key_left = "button_0"
-                    data_key_right = "button_1"
-                devices.append(
-                    XiaomiButton(
-                        device, "Wall Switch (Left)", data_key_left, hass, gateway
-                    )
-                )
-                devices.append(
-                    XiaomiButton(
-                        device, "Wall Switch (Right)", data_key_right, hass, gateway
-                    )
-                )
-                devices.append(
-                    XiaomiButton(
-                        device, "Wall Switch (Both)", "dual_channel", hass, gateway
-                    )
-                )
-            elif model in ["cube", "sensor_cube", "sensor_cube.aqgl01"]:
-                devices.append(XiaomiCube(device, hass, gateway))
-            elif model in ["vibration", "vibration.aq1"]:
-                devices.append(XiaomiVibration(device, "Vibration", "status", gateway))
-            else:
-                _LOGGER.warning("Unmapped Device Model %s", model)
+            devices.extend(_create_entities(hass, device, gateway))
 
     add_entities(devices)
 
+    def add_new_device(gateway, device_type, device):
+        """Add the entities of a device which answered after setup."""
+        if device_type == "binary_sensor":
+            add_entities(_create_entities(hass, device, gateway))
+
+    dispatcher_connect(hass, SIGNAL_NEW_DEVICE, add_new_device)
+
+
+def _create_entities(hass, device, gateway):
+    """Create the entities of one device."""
+    devices = []
+    model = device["model"]
+    if model in ["motion", "sensor_motion", "sensor_motion.aq2"]:
+        devices.append(XiaomiMotionSensor(device, hass, gateway))
+    elif model in ["magnet", "sensor_magnet", "sensor_magnet.aq2"]:
+        devices.append(XiaomiDoorSensor(device, gateway))
+    elif model == "sensor_wleak.aq1":
+        devices.append(XiaomiWaterLeakSensor(device, gateway))
+    elif model in ["smoke", "sensor_smoke"]:
+        devices.append(XiaomiSmokeSensor(device, gateway))
+    elif model in ["natgas", "sensor_natgas"]:
+        devices.append(XiaomiNatgasSensor(device, gateway))
+    elif model in [
+        "switch",
+        "sensor_switch",
+        "sensor_switch.aq2",
+        "sensor_switch.aq3",
+        "remote.b1acn01",
+    ]:
+        if "proto" not in device or int(device["proto"][0:1]) == 1:
+            data_key = "status"
+        else:
+            data_key = "button_0"
+        devices.append(XiaomiButton(device, "Switch", data_key, hass, gateway))
+    elif model in [
+        "86sw1",
+        "sensor_86sw1",
+        "sensor_86sw1.aq1",
+        "remote.b186acn01",
+    ]:
+        if "proto" not in device or int(device["proto"][0:1]) == 1:
+            data_key = "channel_0"
+        else:
+            data_key = "button_0"
+        devices.append(XiaomiButton(device, "Wall Switch", data_key, hass, gateway))
+    elif model in [
+        "86sw2",
+        "sensor_86sw2",
+        "sensor_86sw2.aq1",
+        "remote.b286acn01",
+    ]:
+        if "proto" not in device or int(device["proto"][0:1]) == 1:
+            data_key_left = "channel_0"
+            data_key_right = "channel_1"
+        else:
+            data_key_left = "button_0"
+            data_key_right = "button_1"
+        devices.append(
+            XiaomiButton(device, "Wall Switch (Left)", data_key_left, hass, gateway)
+        )
+        devices.append(
+            XiaomiButton(device, "Wall Switch (Right)", data_key_right, hass, gateway)
+        )
+        devices.append(
+            XiaomiButton(device, "Wall Switch (Both)", "dual_channel", hass, gateway)
+        )
+    elif model in ["cube", "sensor_cube", "sensor_cube.aqgl01"]:
+        devices.append(XiaomiCube(device, hass, gateway))
+    elif model in ["vibration", "vibration.aq1"]:
+        devices.append(XiaomiVibration(device, "Vibration", "status", gateway))
+    else:
+        _LOGGER.warning("Unmapped Device Model %s", model)
+    return devices
+
 
 class XiaomiBinarySensor(XiaomiDevice, BinarySensorDevice):
     """Representation of a base XiaomiBinarySensor."""
@@ -134,6 +140,8 @@ class XiaomiBinarySensor(XiaomiDevice, BinarySensorDevice):
 class XiaomiNatgasSensor(XiaomiBinarySensor):
     """Representation of a XiaomiNatgasSensor."""
 
+    _parsed_keys = (DENSITY,)
+
     def __init__(self, device, xiaomi_hub):
         """Initialize the XiaomiSmokeSensor."""
         self._density = None
@@ -172,6 +180,10 @@ class XiaomiNatgasSensor(XiaomiBinarySensor):
 class XiaomiMotionSensor(XiaomiBinarySensor):
     """Representation of a XiaomiMotionSensor."""
 
+    # A restored motion would only be cleared by the next report
+    _persisted_attributes = ()
+    _parsed_keys = (NO_MOTION,)
+
     def __init__(self, device, hass, xiaomi_hub):
         """Initialize the XiaomiMotionSensor."""
         self._hass = hass
@@ -244,8 +256,9 @@ class XiaomiMotionSensor(XiaomiBinarySensor):
             if self._data_key == "motion_status":
                 if self._unsub_set_no_motion:
                     self._unsub_set_no_motion()
-                self._unsub_set_no_motion = async_call_later(
-                    self._hass, 120, self._async_set_no_motion
+                timers = self._xiaomi_hub.timers
+                self._unsub_set_no_motion = timers.async_call_later(
+                    120, self._async_set_no_motion
                 )
 
             if self.entity_id is not None:
@@ -263,6 +276,8 @@ class XiaomiMotionSensor(XiaomiBinarySensor):
 class XiaomiDoorSensor(XiaomiBinarySensor):
     """Representation of a XiaomiDoorSensor."""
 
+    _parsed_keys = None  # parse_data stops polling on any message
+
     def __init__(self, device, xiaomi_hub):
         """Initialize the XiaomiDoorSensor."""
         self._open_since = 0
@@ -309,6 +324,8 @@ class XiaomiDoorSensor(XiaomiBinarySensor):
 class XiaomiWaterLeakSensor(XiaomiBinarySensor):
     """Representation of a XiaomiWaterLeakSensor."""
 
+    _parsed_keys = None  # parse_data stops polling on any message
+
     def __init__(self, device, xiaomi_hub):
         """Initialize the XiaomiWaterLeakSensor."""
         if "proto" not in device or int(device["proto"][0:1]) == 1:
@@ -343,6 +360,8 @@ class XiaomiWaterLeakSensor(XiaomiBinarySensor):
 class XiaomiSmokeSensor(XiaomiBinarySensor):
     """Representation of a XiaomiSmokeSensor."""
 
+    _parsed_keys = (DENSITY,)
+
     def __init__(self, device, xiaomi_hub):
         """Initialize the XiaomiSmokeSensor."""
         self._density = 0
@@ -380,6 +399,9 @@ class XiaomiSmokeSensor(XiaomiBinarySensor):
 class XiaomiVibration(XiaomiBinarySensor):
     """Representation of a Xiaomi Vibration Sensor."""
 
+    _persisted_attributes = ()
+    _parsed_keys = ()
+
     def __init__(self, device, name, data_key, xiaomi_hub):
         """Initialize the XiaomiVibration."""
         self._last_action = None
@@ -414,6 +436,9 @@ class XiaomiVibration(XiaomiBinarySensor):
 class XiaomiButton(XiaomiBinarySensor):
     """Representation of a Xiaomi Button."""
 
+    _persisted_attributes = ()
+    _parsed_keys = ()
+
     def __init__(self, device, name, data_key, hass, xiaomi_hub):
         """Initialize the XiaomiButton."""
         self._hass = hass
@@ -469,6 +494,9 @@ class XiaomiButton(XiaomiBinarySensor):
 class XiaomiCube(XiaomiBinarySensor):
     """Representation of a Xiaomi Cube."""
 
+    _persisted_attributes = ()
+    _parsed_keys = ("rotate", "rotate_degree")
+
     def __init__(self, device, hass, xiaomi_hub):
         """Initialize the Xiaomi Cube."""
         self._hass = hass
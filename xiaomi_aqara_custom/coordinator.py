@@ -0,0 +1,143 @@
+"""Shared MIIO state polling for the Xiaomi Gateway entities."""
+import asyncio
+from datetime import timedelta
+import logging
+
+from miio.exceptions import DeviceException
+
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_track_time_interval
+
+_LOGGER = logging.getLogger(__name__)
+
+SCAN_INTERVAL = timedelta(seconds=30)
+INFO_TTL = timedelta(hours=1)
+INFO_RETRY_INTERVAL = timedelta(minutes=1)
+
+# Gateway properties fetched in each cycle: key -> (method, params)
+MIIO_PROPERTIES = {
+    "fm": ("get_prop_fm", []),
+    "arming": ("get_arming", []),
+}
+
+
+class GatewayMiioCoordinator:
+    """Fetch the MIIO properties of a gateway once per cycle.
+
+    Entities subscribe instead of polling; every cycle sends all property
+    requests concurrently and notifies the subscribers once. The gateway
+    info (miIO.info) rarely changes, it is cached and refreshed in the
+    background once it is older than INFO_TTL.
+    """
+
+    def __init__(self, hass, gateway, interval=SCAN_INTERVAL):
+        """Initialize the coordinator."""
+        self.hass = hass
+        self.data = {}
+        self.last_update_success = False
+        self._gateway = gateway
+        self._interval = interval
+        self._listeners = []
+        self._unsub_refresh = None
+        self._info = {}
+        self._info_updated = None
+        self._info_failed = None
+        self._info_task = None
+
+    @property
+    def info(self):
+        """Return the cached gateway info, refreshing it when stale.
+
+        Never waits for the gateway: the subscribers are notified once a
+        refresh has completed. After a failed refresh the next one waits
+        INFO_RETRY_INTERVAL.
+        """
+        now = self.hass.loop.time()
+        stale = (
+            self._info_updated is None
+            or now - self._info_updated > INFO_TTL.total_seconds()
+        )
+        retry = (
+            self._info_failed is None
+            or now - self._info_failed > INFO_RETRY_INTERVAL.total_seconds()
+        )
+        if stale and retry and self._info_task is None:
+            self._info_task = self.hass.async_create_task(self._async_refresh_info())
+        return self._info
+
+    async def _async_refresh_info(self):
+        """Fetch the gateway info."""
+        try:
+            info = await self._gateway.miio_client.async_send("miIO.info")
+        except (DeviceException, OSError) as err:
+            _LOGGER.debug("Cannot get info of gateway %s: %s", self._gateway.sid, err)
+            self._info_failed = self.hass.loop.time()
+            return
+        finally:
+            self._info_task = None
+
+        self._info = {
+            "model": info.get("model"),
+            "miio_token": info.get("token"),
+            "ip": info.get("netif", {}).get("localIp"),
+        }
+        self._info_updated = self.hass.loop.time()
+        self.async_update_listeners()
+
+    @callback
+    def async_add_listener(self, update_callback):
+        """Subscribe to updates, returns a callback to unsubscribe."""
+        self._listeners.append(update_callback)
+        if self._unsub_refresh is None:
+            self._unsub_refresh = async_track_time_interval(
+                self.hass, self.async_refresh, self._interval
+            )
+            self.hass.async_create_task(self.async_refresh())
+
+        @callback
+        def remove_listener():
+            """Unsubscribe and stop polling without subscribers."""
+            self._listeners.remove(update_callback)
+            if not self._listeners and self._unsub_refresh is not None:
+                self._unsub_refresh()
+                self._unsub_refresh = None
+
+        return remove_listener
+
+    async def async_refresh(self, now=None):
+        """Fetch all properties and notify the subscribers."""
+        client = self._gateway.miio_client
+        results = await asyncio.gather(
+            *(
+                client.async_send(method, params)
+                for method, params in MIIO_PROPERTIES.values()
+            ),
+            return_exceptions=True,
+        )
+
+        success = False
+        for key, result in zip(MIIO_PROPERTIES, results):
+            if isinstance(result, (DeviceException, OSError)):
+                _LOGGER.debug(
+                    "Cannot get %s of gateway %s: %s", key, self._gateway.sid, result
+                )
+                continue
+            if isinstance(result, Exception):
+                raise result
+            self.data[key] = result
+            success = True
+        self.last_update_success = success
+
+        self.async_update_listeners()
+
+    @callback
+    def async_set(self, key, value):
+        """Store a value known from a command and notify the subscribers."""
+        self.data[key] = value
+        self.async_update_listeners()
+
+    @callback
+    def async_update_listeners(self):
+        """Notify the subscribers."""
+        for update_callback in list(self._listeners):
+            update_callback()
@@ -2,8 +2,9 @@
 import logging
 
 from homeassistant.components.cover import ATTR_POSITION, CoverDevice
+from homeassistant.helpers.dispatcher import dispatcher_connect
 
-from . import PY_XIAOMI_GATEWAY, XiaomiDevice
+from . import PY_XIAOMI_GATEWAY, SIGNAL_NEW_DEVICE, XiaomiDevice
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -18,19 +19,35 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     devices = []
     for (_, gateway) in hass.data[PY_XIAOMI_GATEWAY].gateways.items():
         for device in gateway.devices["cover"]:
-            model = device["model"]
-            if model in ["curtain", "curtain.aq2", "curtain.hagl04"]:
-                if "proto" not in device or int(device["proto"][0:1]) == 1:
-                    data_key = DATA_KEY_PROTO_V1
-                else:
-                    data_key = DATA_KEY_PROTO_V2
-                devices.append(XiaomiGenericCover(device, "Curtain", data_key, gateway))
+            devices.extend(_create_entities(hass, device, gateway))
     add_entities(devices)
 
+    def add_new_device(gateway, device_type, device):
+        """Add the entities of a device which answered after setup."""
+        if device_type == "cover":
+            add_entities(_create_entities(hass, device, gateway))
+
+    dispatcher_connect(hass, SIGNAL_NEW_DEVICE, add_new_device)
+
+
+def _create_entities(hass, device, gateway):
+    """Create the entities of one device."""
+    devices = []
+    model = device["model"]
+    if model in ["curtain", "curtain.aq2", "curtain.hagl04"]:
+        if "proto" not in device or int(device["proto"][0:1]) == 1:
+            data_key = DATA_KEY_PROTO_V1
+        else:
+            data_key = DATA_KEY_PROTO_V2
+        devices.append(XiaomiGenericCover(device, "Curtain", data_key, gateway))
+    return devices
+
 
 class XiaomiGenericCover(XiaomiDevice, CoverDevice):
     """Representation of a XiaomiGenericCover."""
 
+    _parsed_keys = (ATTR_CURTAIN_LEVEL,)
+
     def __init__(self, device, name, data_key, xiaomi_hub):
         """Initialize the XiaomiGenericCover."""
         self._data_key = data_key
@@ -47,25 +64,24 @@ class XiaomiGenericCover(XiaomiDevice, CoverDevice):
         """Return if the cover is closed."""
         return self.current_cover_position <= 0
 
-    def close_cover(self, **kwargs):
+    async def async_close_cover(self, **kwargs):
         """Close the cover."""
-        self._write_to_hub(self._sid, **{self._data_key: "close"})
+        await self._async_write_to_hub(self._sid, **{self._data_key: "close"})
 
-    def open_cover(self, **kwargs):
+    async def async_open_cover(self, **kwargs):
         """Open the cover."""
-        self._write_to_hub(self._sid, **{self._data_key: "open"})
+        await self._async_write_to_hub(self._sid, **{self._data_key: "open"})
 
-    def stop_cover(self, **kwargs):
+    async def async_stop_cover(self, **kwargs):
         """Stop the cover."""
-        self._write_to_hub(self._sid, **{self._data_key: "stop"})
+        await self._async_write_to_hub(self._sid, **{self._data_key: "stop"})
 
-    def set_cover_position(self, **kwargs):
+    async def async_set_cover_position(self, **kwargs):
         """Move the cover to a specific position."""
         position = kwargs.get(ATTR_POSITION)
-        if self._data_key == DATA_KEY_PROTO_V2:
-            self._write_to_hub(self._sid, **{ATTR_CURTAIN_LEVEL: position})
-        else:
-            self._write_to_hub(self._sid, **{ATTR_CURTAIN_LEVEL: str(position)})
+        if self._data_key != DATA_KEY_PROTO_V2:
+            position = str(position)
+        await self._async_write_to_hub(self._sid, **{ATTR_CURTAIN_LEVEL: position})
 
     def parse_data(self, data, raw_data):
         """Parse data sent by gateway."""
@@ -10,9 +10,11 @@ from homeassistant.components.light import (
     SUPPORT_COLOR,
     Light,
 )
+from homeassistant.helpers.dispatcher import dispatcher_connect
 import homeassistant.util.color as color_util
 
-from . import PY_XIAOMI_GATEWAY, XiaomiDevice
+from . import PY_XIAOMI_GATEWAY, SIGNAL_NEW_DEVICE, XiaomiDevice
+from .writer import WRITE_PRIORITY_COMFORT
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -22,15 +24,32 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     devices = []
     for (_, gateway) in hass.data[PY_XIAOMI_GATEWAY].gateways.items():
         for device in gateway.devices["light"]:
-            model = device["model"]
-            if model in ["gateway", "gateway.v3"]:
-                devices.append(XiaomiGatewayLight(device, "Gateway Light", gateway))
+            devices.extend(_create_entities(hass, device, gateway))
     add_entities(devices)
 
+    def add_new_device(gateway, device_type, device):
+        """Add the entities of a device which answered after setup."""
+        if device_type == "light":
+            add_entities(_create_entities(hass, device, gateway))
+
+    dispatcher_connect(hass, SIGNAL_NEW_DEVICE, add_new_device)
+
+
+def _create_entities(hass, device, gateway):
+    """Create the entities of one device."""
+    devices = []
+    model = device["model"]
+    if model in ["gateway", "gateway.v3"]:
+        devices.append(XiaomiGatewayLight(device, "Gateway Light", gateway))
+    return devices
+
 
 class XiaomiGatewayLight(XiaomiDevice, Light):
     """Representation of a XiaomiGatewayLight."""
 
+    _parsed_keys = ()
+    _write_priority = WRITE_PRIORITY_COMFORT
+
     def __init__(self, device, name, xiaomi_hub):
         """Initialize the XiaomiGatewayLight."""
         self._data_key = "rgb"
@@ -90,7 +109,7 @@ class XiaomiGatewayLight(XiaomiDevice, Light):
         """Return the supported features."""
         return SUPPORT_BRIGHTNESS | SUPPORT_COLOR
 
-    def turn_on(self, **kwargs):
+    async def async_turn_on(self, **kwargs):
         """Turn the light on."""
         if ATTR_HS_COLOR in kwargs:
             self._hs = kwargs[ATTR_HS_COLOR]
@@ -103,12 +122,12 @@ class XiaomiGatewayLight(XiaomiDevice, Light):
         rgbhex = binascii.hexlify(struct.pack("BBBB", *rgba)).decode("ASCII")
         rgbhex = int(rgbhex, 16)
 
-        if self._write_to_hub(self._sid, **{self._data_key: rgbhex}):
+        if await self._async_write_to_hub(self._sid, **{self._data_key: rgbhex}):
             self._state = True
-            self.schedule_update_ha_state()
+            self.async_schedule_update_ha_state()
 
-    def turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         """Turn the light off."""
-        if self._write_to_hub(self._sid, **{self._data_key: 0}):
+        if await self._async_write_to_hub(self._sid, **{self._data_key: 0}):
             self._state = False
-            self.schedule_update_ha_state()
+            self.async_schedule_update_ha_state()
@@ -4,9 +4,9 @@ import logging
 from homeassistant.components.lock import LockDevice
 from homeassistant.const import STATE_LOCKED, STATE_UNLOCKED
 from homeassistant.core import callback
-from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
 
-from . import PY_XIAOMI_GATEWAY, XiaomiDevice
+from . import PY_XIAOMI_GATEWAY, SIGNAL_NEW_DEVICE, XiaomiDevice
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -26,15 +26,34 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
 
     for gateway in hass.data[PY_XIAOMI_GATEWAY].gateways.values():
         for device in gateway.devices["lock"]:
-            model = device["model"]
-            if model == "lock.aq1":
-                devices.append(XiaomiAqaraLock(device, "Lock", gateway))
+            devices.extend(_create_entities(device, gateway))
     async_add_entities(devices)
 
+    @callback
+    def async_add_new_device(gateway, device_type, device):
+        """Add the entities of a device which answered after setup."""
+        if device_type == "lock":
+            async_add_entities(_create_entities(device, gateway))
+
+    async_dispatcher_connect(hass, SIGNAL_NEW_DEVICE, async_add_new_device)
+
+
+def _create_entities(device, gateway):
+    """Create the entities of one device."""
+    devices = []
+    model = device["model"]
+    if model == "lock.aq1":
+        devices.append(XiaomiAqaraLock(device, "Lock", gateway))
+    return devices
+
 
 class XiaomiAqaraLock(LockDevice, XiaomiDevice):
     """Representation of a XiaomiAqaraLock."""
 
+    # Unlocking is transient, the lock relocks on its own
+    _persisted_attributes = ()
+    _parsed_keys = (VERIFIED_WRONG_KEY, FINGER_KEY, PASSWORD_KEY, CARD_KEY)
+
     def __init__(self, device, name, xiaomi_hub):
         """Initialize the XiaomiAqaraLock."""
         self._changed_by = 0
@@ -78,8 +97,8 @@ class XiaomiAqaraLock(LockDevice, XiaomiDevice):
                 self._changed_by = int(value)
                 self._verified_wrong_times = 0
                 self._state = STATE_UNLOCKED
-                async_call_later(
-                    self.hass, UNLOCK_MAINTAIN_TIME, self.clear_unlock_state
+                self._xiaomi_hub.timers.async_call_later(
+                    UNLOCK_MAINTAIN_TIME, self.clear_unlock_state
                 )
                 return True
 
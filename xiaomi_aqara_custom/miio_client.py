@@ -0,0 +1,302 @@
+"""Asyncio MIIO client for the Xiaomi Gateway."""
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import random
+import struct
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from miio.exceptions import DeviceError, DeviceException
+
+_LOGGER = logging.getLogger(__name__)
+
+MIIO_PORT = 54321
+MIIO_TIMEOUT = 5.0
+MIIO_RETRIES = 2
+# Minimum time between two commands sent to a gateway
+MIIO_COMMAND_INTERVAL = 0.2
+
+HELLO = bytes.fromhex(
+    "21310020ffffffffffffffffffffffffffffffffffffffffffffffffffffffff"
+)
+HEADER = struct.Struct(">HHIII")
+MAGIC = 0x2131
+
+
+def _md5(data):
+    return hashlib.md5(data).digest()
+
+
+class MiioCodec:
+    """Encrypt, decrypt and frame MIIO packets for one token."""
+
+    def __init__(self, token):
+        """Derive the AES key and IV from the token."""
+        self.token = token
+        self._key = _md5(token)
+        self._iv = _md5(self._key + token)
+
+    def _cipher(self):
+        return Cipher(
+            algorithms.AES(self._key), modes.CBC(self._iv), backend=default_backend()
+        )
+
+    def encrypt(self, plaintext):
+        """Encrypt a payload."""
+        padder = padding.PKCS7(128).padder()
+        padded = padder.update(plaintext) + padder.finalize()
+        encryptor = self._cipher().encryptor()
+        return encryptor.update(padded) + encryptor.finalize()
+
+    def decrypt(self, ciphertext):
+        """Decrypt a payload."""
+        decryptor = self._cipher().decryptor()
+        padded = decryptor.update(ciphertext) + decryptor.finalize()
+        unpadder = padding.PKCS7(128).unpadder()
+        return unpadder.update(padded) + unpadder.finalize()
+
+    def build(self, payload, device_id, stamp):
+        """Build an encrypted packet carrying a JSON payload."""
+        encrypted = self.encrypt(json.dumps(payload).encode())
+        header = HEADER.pack(MAGIC, 32 + len(encrypted), 0, device_id, stamp)
+        return header + _md5(header + self.token + encrypted) + encrypted
+
+    def parse(self, packet):
+        """Parse a packet into (device_id, stamp, payload).
+
+        The payload is None for a handshake (hello) packet.
+        """
+        if len(packet) < 32:
+            raise ValueError("Packet too short")
+        magic, length, _, device_id, stamp = HEADER.unpack_from(packet)
+        if magic != MAGIC or length != len(packet):
+            raise ValueError("Malformed packet")
+        if length == 32:
+            return device_id, stamp, None
+
+        encrypted = packet[32:]
+        if _md5(packet[:16] + self.token + encrypted) != packet[16:32]:
+            raise ValueError("Checksum mismatch")
+        plaintext = self.decrypt(encrypted).rstrip(b"\x00")
+        return device_id, stamp, json.loads(plaintext.decode())
+
+
+class _MiioProtocol(asyncio.DatagramProtocol):
+    """Hand the datagrams of a MIIO session to its client."""
+
+    def __init__(self, client):
+        """Initialize the protocol."""
+        self._client = client
+
+    def datagram_received(self, data, addr):
+        """Pass a datagram to the client."""
+        self._client.packet_received(data)
+
+    def error_received(self, exc):
+        """Log socket errors, the pending requests time out on their own."""
+        _LOGGER.debug("MIIO socket error: %s", exc)
+
+
+class AsyncMiioClient:
+    """MIIO client with a cached handshake and pipelined requests.
+
+    The device id and the offset to the device's stamp are kept from the
+    handshake, so requests do not repeat it. Responses are matched to
+    requests by id, so several requests may be in flight at once.
+    """
+
+    def __init__(self, host, token, port=MIIO_PORT, timeout=MIIO_TIMEOUT):
+        """Initialize the client, the socket is opened on first use."""
+        self.host = host
+        self.port = port
+        self._timeout = timeout
+        self._codec = MiioCodec(bytes.fromhex(token))
+        self._transport = None
+        self._device_id = None
+        self._stamp_offset = None
+        self._handshake = None
+        self._pending = {}
+        self._next_id = random.randint(1, 9999)
+
+    @property
+    def loop(self):
+        """Return the running event loop."""
+        return asyncio.get_event_loop()
+
+    async def _async_connect(self):
+        if self._transport is None:
+            self._transport, _ = await self.loop.create_datagram_endpoint(
+                lambda: _MiioProtocol(self), remote_addr=(self.host, self.port)
+            )
+
+    async def _async_handshake(self):
+        """Fetch the device id and stamp, shared by concurrent callers."""
+        if self._handshake is None:
+            handshake = self._handshake = self.loop.create_future()
+            self._transport.sendto(HELLO)
+            self.loop.call_later(self._timeout, self._handshake_timeout, handshake)
+        await self._handshake
+
+    def _handshake_timeout(self, handshake):
+        if self._handshake is handshake:
+            self._handshake = None
+        if not handshake.done():
+            handshake.set_exception(
+                DeviceException(f"No handshake response from {self.host}")
+            )
+
+    def _stamp(self):
+        return int(self.loop.time() + self._stamp_offset)
+
+    def packet_received(self, packet):
+        """Resolve the handshake or the request a packet answers."""
+        try:
+            device_id, stamp, payload = self._codec.parse(packet)
+        except ValueError as error:
+            _LOGGER.debug("Dropping MIIO packet from %s: %s", self.host, error)
+            return
+
+        self._device_id = device_id
+        self._stamp_offset = stamp - self.loop.time()
+        if payload is None:
+            handshake, self._handshake = self._handshake, None
+            if handshake is not None and not handshake.done():
+                handshake.set_result(None)
+            return
+
+        future = self._pending.pop(payload.get("id"), None)
+        if future is None or future.done():
+            _LOGGER.debug("Unexpected MIIO response from %s: %s", self.host, payload)
+            return
+        if "error" in payload:
+            future.set_exception(DeviceError(payload["error"]))
+        else:
+            future.set_result(payload.get("result"))
+
+    def _request_id(self):
+        self._next_id = self._next_id % 9999 + 1
+        return self._next_id
+
+    async def async_send(self, method, params=None):
+        """Send a command and return its result."""
+        await self._async_connect()
+        for attempt in range(MIIO_RETRIES):
+            if self._stamp_offset is None:
+                await self._async_handshake()
+
+            request_id = self._request_id()
+            future = self._pending[request_id] = self.loop.create_future()
+            request = {"id": request_id, "method": method, "params": params or []}
+            _LOGGER.debug("MIIO %s >> %s", self.host, request)
+            self._transport.sendto(
+                self._codec.build(request, self._device_id, self._stamp() + 1)
+            )
+            try:
+                return await asyncio.wait_for(future, self._timeout)
+            except asyncio.TimeoutError:
+                self._pending.pop(request_id, None)
+                # The device may have rebooted, redo the handshake.
+                self._stamp_offset = None
+                _LOGGER.debug(
+                    "MIIO %s: no response to %s (attempt %s)",
+                    self.host, method, attempt + 1)
+
+        raise DeviceException(f"No response from {self.host} to {method}")
+
+    def close(self):
+        """Close the socket and fail the pending requests."""
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(DeviceException("Connection closed"))
+        self._pending.clear()
+        self._stamp_offset = None
+
+
+class MiioCommandQueue:
+    """Send the MIIO commands of a gateway one at a time.
+
+    A queued command is replaced by a later command of the same method,
+    keeping its place in the queue, so ramping a value only sends its
+    latest value. Every caller of a replaced
+    command gets the parameters which were actually sent and their result.
+    """
+
+    def __init__(self, send, interval=MIIO_COMMAND_INTERVAL):
+        """Initialize the queue with the coroutine function sending commands."""
+        self._send = send
+        self._interval = interval
+        self._queue = OrderedDict()
+        self._worker = None
+        self._inflight = []
+        self._next_key = 0
+
+    @property
+    def loop(self):
+        """Return the running event loop."""
+        return asyncio.get_event_loop()
+
+    def __len__(self):
+        """Return the number of queued commands."""
+        return len(self._queue)
+
+    async def async_send(self, method, params=None, coalesce=True):
+        """Queue a command and return the (params, result) sent for it."""
+        if coalesce:
+            key = method
+        else:
+            self._next_key += 1
+            key = self._next_key
+
+        future = self.loop.create_future()
+        queued = self._queue.get(key)
+        futures = queued[2] if queued is not None else []
+        futures.append(future)
+        # Assigning an existing key keeps its position
+        self._queue[key] = (method, params or [], futures)
+
+        if self._worker is None:
+            self._worker = self.loop.create_task(self._async_run())
+        return await future
+
+    async def _async_run(self):
+        """Send the queued commands, keeping the interval between them."""
+        try:
+            while self._queue:
+                _, (method, params, futures) = self._queue.popitem(last=False)
+                self._inflight = futures
+                started = self.loop.time()
+                try:
+                    result = await self._send(method, params)
+                except Exception as err:  # pylint: disable=broad-except
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(err)
+                else:
+                    for future in futures:
+                        if not future.done():
+                            future.set_result((params, result))
+                self._inflight = []
+                await asyncio.sleep(self._interval - (self.loop.time() - started))
+        finally:
+            self._worker = None
+
+    def close(self):
+        """Stop sending and fail the queued and the in-flight commands."""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        pending = [futures for _, _, futures in self._queue.values()]
+        pending.append(self._inflight)
+        for futures in pending:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(DeviceException("Connection closed"))
+        self._queue.clear()
+        self._inflight = []
@@ -1,4 +1,5 @@
 """Support for Xiaomi Aqara sensors."""
+from datetime import timedelta
 import logging
 
 from homeassistant.const import (
@@ -8,11 +9,17 @@ from homeassistant.const import (
     DEVICE_CLASS_TEMPERATURE,
     TEMP_CELSIUS,
 )
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import dispatcher_connect
+from homeassistant.helpers.entity import Entity
+from homeassistant.helpers.event import async_track_time_interval
 
-from . import PY_XIAOMI_GATEWAY, XiaomiDevice
+from . import PY_XIAOMI_GATEWAY, SIGNAL_NEW_DEVICE, XiaomiDevice
 
 _LOGGER = logging.getLogger(__name__)
 
+STATS_INTERVAL = timedelta(minutes=1)
+
 SENSOR_TYPES = {
     "temperature": [TEMP_CELSIUS, None, DEVICE_CLASS_TEMPERATURE],
     "humidity": ["%", None, DEVICE_CLASS_HUMIDITY],
@@ -28,41 +35,46 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     devices = []
     for (_, gateway) in hass.data[PY_XIAOMI_GATEWAY].gateways.items():
         for device in gateway.devices["sensor"]:
-            if device["model"] == "sensor_ht":
-                devices.append(
-                    XiaomiSensor(device, "Temperature", "temperature", gateway)
-                )
-                devices.append(XiaomiSensor(device, "Humidity", "humidity", gateway))
-            elif device["model"] in ["weather", "weather.v1"]:
-                devices.append(
-                    XiaomiSensor(device, "Temperature", "temperature", gateway)
-                )
-                devices.append(XiaomiSensor(device, "Humidity", "humidity", gateway))
-                devices.append(XiaomiSensor(device, "Pressure", "pressure", gateway))
-            elif device["model"] == "sensor_motion.aq2":
-                devices.append(XiaomiSensor(device, "Illumination", "lux", gateway))
-            elif device["model"] in ["gateway", "gateway.v3", "acpartner.v3"]:
-                devices.append(
-                    XiaomiSensor(device, "Illumination", "illumination", gateway)
-                )
-            elif device["model"] in ["vibration"]:
-                devices.append(
-                    XiaomiSensor(device, "Bed Activity", "bed_activity", gateway)
-                )
-                devices.append(
-                    XiaomiSensor(device, "Tilt Angle", "final_tilt_angle", gateway)
-                )
-                devices.append(
-                    XiaomiSensor(device, "Coordination", "coordination", gateway)
-                )
-            else:
-                _LOGGER.warning("Unmapped Device Model ")
+            devices.extend(_create_entities(hass, device, gateway))
+        devices.append(XiaomiGatewayStatsSensor(gateway))
     add_entities(devices)
 
+    def add_new_device(gateway, device_type, device):
+        """Add the entities of a device which answered after setup."""
+        if device_type == "sensor":
+            add_entities(_create_entities(hass, device, gateway))
+
+    dispatcher_connect(hass, SIGNAL_NEW_DEVICE, add_new_device)
+
+
+def _create_entities(hass, device, gateway):
+    """Create the entities of one device."""
+    devices = []
+    if device["model"] == "sensor_ht":
+        devices.append(XiaomiSensor(device, "Temperature", "temperature", gateway))
+        devices.append(XiaomiSensor(device, "Humidity", "humidity", gateway))
+    elif device["model"] in ["weather", "weather.v1"]:
+        devices.append(XiaomiSensor(device, "Temperature", "temperature", gateway))
+        devices.append(XiaomiSensor(device, "Humidity", "humidity", gateway))
+        devices.append(XiaomiSensor(device, "Pressure", "pressure", gateway))
+    elif device["model"] == "sensor_motion.aq2":
+        devices.append(XiaomiSensor(device, "Illumination", "lux", gateway))
+    elif device["model"] in ["gateway", "gateway.v3", "acpartner.v3"]:
+        devices.append(XiaomiSensor(device, "Illumination", "illumination", gateway))
+    elif device["model"] in ["vibration"]:
+        devices.append(XiaomiSensor(device, "Bed Activity", "bed_activity", gateway))
+        devices.append(XiaomiSensor(device, "Tilt Angle", "final_tilt_angle", gateway))
+        devices.append(XiaomiSensor(device, "Coordination", "coordination", gateway))
+    else:
+        _LOGGER.warning("Unmapped Device Model ")
+    return devices
+
 
 class XiaomiSensor(XiaomiDevice):
     """Representation of a XiaomiSensor."""
 
+    _parsed_keys = ()
+
     def __init__(self, device, name, data_key, xiaomi_hub):
         """Initialize the XiaomiSensor."""
         self._data_key = data_key
@@ -122,3 +134,64 @@ class XiaomiSensor(XiaomiDevice):
         else:
             self._state = round(value, 1)
         return True
+
+
+class XiaomiGatewayStatsSensor(Entity):
+    """Message counters of a gateway, to tune the receive pipeline.
+
+    The counters change with every message, they are written once every
+    STATS_INTERVAL instead.
+    """
+
+    def __init__(self, xiaomi_hub):
+        """Initialize the sensor."""
+        self._xiaomi_hub = xiaomi_hub
+        self._name = f"gateway_stats_{xiaomi_hub.sid}"
+        self._unsub_interval = None
+
+    async def async_added_to_hass(self):
+        """Start writing the counters periodically."""
+        self._unsub_interval = async_track_time_interval(
+            self.hass, self._async_write_stats, STATS_INTERVAL
+        )
+
+    async def async_will_remove_from_hass(self):
+        """Stop writing the counters."""
+        if self._unsub_interval is not None:
+            self._unsub_interval()
+            self._unsub_interval = None
+
+    @callback
+    def _async_write_stats(self, now):
+        """Write the current counters."""
+        self.async_write_ha_state()
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def unique_id(self):
+        """Return a unique ID."""
+        return self._name
+
+    @property
+    def should_poll(self):
+        """Return the polling state. The counters are written on an interval."""
+        return False
+
+    @property
+    def icon(self):
+        """Return the icon to use in the frontend."""
+        return "mdi:counter"
+
+    @property
+    def state(self):
+        """Return the number of suppressed duplicate messages."""
+        return self._xiaomi_hub.stats["duplicates"]
+
+    @property
+    def device_state_attributes(self):
+        """Return all counters of the gateway."""
+        return dict(self._xiaomi_hub.stats)
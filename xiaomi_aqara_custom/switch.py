@@ -2,8 +2,11 @@
 import logging
 
 from homeassistant.components.switch import SwitchDevice
+from homeassistant.core import callback
+from homeassistant.helpers.dispatcher import dispatcher_connect
 
-from . import PY_XIAOMI_GATEWAY, XiaomiDevice
+from . import PY_XIAOMI_GATEWAY, SIGNAL_NEW_DEVICE, XiaomiDevice
+from .writer import WRITE_PRIORITY_COMFORT
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -25,72 +28,84 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
     devices = []
     for (_, gateway) in hass.data[PY_XIAOMI_GATEWAY].gateways.items():
         for device in gateway.devices["switch"]:
-            model = device["model"]
-            if model == "plug":
-                if "proto" not in device or int(device["proto"][0:1]) == 1:
-                    data_key = "status"
-                else:
-                    data_key = "channel_0"
-                devices.append(
-                    XiaomiGenericSwitch(device, "Plug", data_key, True, gateway)
-                )
-            elif model in ["ctrl_neutral1", "ctrl_neutral1.aq1"]:
-                devices.append(
-                    XiaomiGenericSwitch(
-                        device, "Wall Switch", "channel_0", False, gateway
-                    )
-                )
-            elif model in ["ctrl_ln1", "ctrl_ln1.aq1"]:
-                devices.append(
-                    XiaomiGenericSwitch(
-                        device, "Wall Switch LN", "channel_0", False, gateway
-                    )
-                )
-            elif model in ["ctrl_neutral2", "ctrl_neutral2.aq1"]:
-                devices.append(
-                    XiaomiGenericSwitch(
-                        device, "Wall Switch Left", "channel_0", False, gateway
-                    )
-                )
-                devices.append(
-                    XiaomiGenericSwitch(
-                        device, "Wall Switch Right", "channel_1", False, gateway
-                    )
-                )
-            elif model in ["ctrl_ln2", "ctrl_ln2.aq1"]:
-                devices.append(
-                    XiaomiGenericSwitch(
-                        device, "Wall Switch LN Left", "channel_0", False, gateway
-                    )
-                )
-                devices.append(
-                    XiaomiGenericSwitch(
-                        device, "Wall Switch LN Right", "channel_1", False, gateway
-                    )
-                )
-            elif model in ["86plug", "ctrl_86plug", "ctrl_86plug.aq1"]:
-                if "proto" not in device or int(device["proto"][0:1]) == 1:
-                    data_key = "status"
-                else:
-                    data_key = "channel_0"
-                devices.append(
-                    XiaomiGenericSwitch(device, "Wall Plug", data_key, True, gateway)
-                )
-
-    # add gateway internal switches
-    devices.append(
-        XiaomiGatewayRadioSwitch(gateway)
-    )
-    devices.append(
-        XiaomiGatewayAlarmSwitch(gateway)
-    )
-    _LOGGER.debug(f"Added {gateway.sid} switches to entities.")
+            devices.extend(_create_entities(hass, device, gateway))
+
+        # add gateway internal switches
+        if gateway.miio_client is None:
+            continue
+        devices.append(
+            XiaomiGatewayRadioSwitch(gateway)
+        )
+        devices.append(
+            XiaomiGatewayAlarmSwitch(gateway)
+        )
+        _LOGGER.debug(f"Added {gateway.sid} switches to entities.")
     add_entities(devices)
 
+    def add_new_device(gateway, device_type, device):
+        """Add the entities of a device which answered after setup."""
+        if device_type == "switch":
+            add_entities(_create_entities(hass, device, gateway))
+
+    dispatcher_connect(hass, SIGNAL_NEW_DEVICE, add_new_device)
+
+
+def _create_entities(hass, device, gateway):
+    """Create the entities of one device."""
+    devices = []
+    model = device["model"]
+    if model == "plug":
+        if "proto" not in device or int(device["proto"][0:1]) == 1:
+            data_key = "status"
+        else:
+            data_key = "channel_0"
+        devices.append(XiaomiGenericSwitch(device, "Plug", data_key, True, gateway))
+    elif model in ["ctrl_neutral1", "ctrl_neutral1.aq1"]:
+        devices.append(
+            XiaomiGenericSwitch(device, "Wall Switch", "channel_0", False, gateway)
+        )
+    elif model in ["ctrl_ln1", "ctrl_ln1.aq1"]:
+        devices.append(
+            XiaomiGenericSwitch(device, "Wall Switch LN", "channel_0", False, gateway)
+        )
+    elif model in ["ctrl_neutral2", "ctrl_neutral2.aq1"]:
+        devices.append(
+            XiaomiGenericSwitch(device, "Wall Switch Left", "channel_0", False, gateway)
+        )
+        devices.append(
+            XiaomiGenericSwitch(
+                device, "Wall Switch Right", "channel_1", False, gateway
+            )
+        )
+    elif model in ["ctrl_ln2", "ctrl_ln2.aq1"]:
+        devices.append(
+            XiaomiGenericSwitch(
+                device, "Wall Switch LN Left", "channel_0", False, gateway
+            )
+        )
+        devices.append(
+            XiaomiGenericSwitch(
+                device, "Wall Switch LN Right", "channel_1", False, gateway
+            )
+        )
+    elif model in ["86plug", "ctrl_86plug", "ctrl_86plug.aq1"]:
+        if "proto" not in device or int(device["proto"][0:1]) == 1:
+            data_key = "status"
+        else:
+            data_key = "channel_0"
+        devices.append(
+            XiaomiGenericSwitch(device, "Wall Plug", data_key, True, gateway)
+        )
+    return devices
+
 
 class XiaomiGenericSwitch(XiaomiDevice, SwitchDevice):
     """Representation of a XiaomiPlug."""
 
+    _persisted_attributes = ("_state", "_in_use", "_load_power", "_power_consumed")
+    _parsed_keys = (IN_USE, POWER_CONSUMED, ENERGY_CONSUMED, LOAD_POWER)
+    _write_priority = WRITE_PRIORITY_COMFORT
+
     def __init__(self, device, name, data_key, supports_power_consumption, xiaomi_hub):
         """Initialize the XiaomiPlug."""
         self._data_key = data_key
@@ -131,17 +146,22 @@ class XiaomiGenericSwitch(XiaomiDevice, SwitchDevice):
         """Return the polling state. Polling needed for Zigbee plug only."""
         return self._supports_power_consumption
 
-    def turn_on(self, **kwargs):
+    async def async_set_state(self, state):
+        """Switch on or off, returns True if the gateway confirmed it."""
+        value = "on" if state else "off"
+        if not await self._async_write_to_hub(self._sid, **{self._data_key: value}):
+            return False
+        self._state = state
+        self.async_schedule_update_ha_state()
+        return True
+
+    async def async_turn_on(self, **kwargs):
         """Turn the switch on."""
-        if self._write_to_hub(self._sid, **{self._data_key: "on"}):
-            self._state = True
-            self.schedule_update_ha_state()
+        await self.async_set_state(True)
 
-    def turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         """Turn the switch off."""
-        if self._write_to_hub(self._sid, **{self._data_key: "off"}):
-            self._state = False
-            self.schedule_update_ha_state()
+        await self.async_set_state(False)
 
     def parse_data(self, data, raw_data):
         """Parse data sent by gateway."""
@@ -181,15 +201,18 @@ class XiaomiGatewayGenericSwitch(SwitchDevice):
         """init switch"""
         self._state = None
         self._name = None
-        self.miio = xiaomi_hub.miio
+        self._xiaomi_hub = xiaomi_hub
+        self._remove_listener = None
 
-        """Return the gateway attributes."""
-        miio_info = self.miio.info()
-        self._gw_attrs = {
-            "model": miio_info.data.get("model"),
-            "miio_token": miio_info.data.get("token"),
-            "ip": miio_info.network_interface.get("localIp")
-        }
+    @property
+    def _gw_attrs(self):
+        """Return the gateway attributes, cached by the coordinator."""
+        return self.coordinator.info
+
+    @property
+    def miio_queue(self):
+        """Return the MIIO command queue of the gateway."""
+        return self._xiaomi_hub.miio_queue
 
     @property
     def name(self):
@@ -203,8 +226,58 @@ class XiaomiGatewayGenericSwitch(SwitchDevice):
 
     @property
     def should_poll(self):
-        """Return the polling state. """
-        return True
+        """Return the polling state. The gateway coordinator pushes updates."""
+        return False
+
+    @property
+    def available(self):
+        """Return True if the gateway is available."""
+        return self._xiaomi_hub.available
+
+    @property
+    def coordinator(self):
+        """Return the MIIO state coordinator of the gateway."""
+        return self._xiaomi_hub.miio_coordinator
+
+    async def async_added_to_hass(self):
+        """Subscribe to the gateway coordinator."""
+        self._remove_listener = self.coordinator.async_add_listener(
+            self._async_coordinator_update
+        )
+        self._xiaomi_hub.entities.add(self)
+
+    async def async_will_remove_from_hass(self):
+        """Unsubscribe from the gateway coordinator."""
+        self._xiaomi_hub.entities.discard(self)
+        if self._remove_listener is not None:
+            self._remove_listener()
+            self._remove_listener = None
+
+    @callback
+    def _async_coordinator_update(self):
+        """Take the state from the latest coordinator data."""
+        self.update_from_data(self.coordinator.data)
+        self.async_schedule_update_ha_state()
+
+    def update_from_data(self, data):
+        """Update the state from the coordinator data."""
+        raise NotImplementedError()
+
+    def state_to_data(self, state):
+        """Return the coordinator (key, value) a confirmed state amounts to."""
+        raise NotImplementedError()
+
+    async def _async_send(self, method, value):
+        """Switch through the gateway queue.
+
+        A later command may replace this one in the queue, the state is
+        taken from the value actually sent and written to the coordinator,
+        so the other entities of the gateway see it before the next poll.
+        """
+        params, resp = await self.miio_queue.async_send(method, [value])
+        if 'ok' in resp:
+            self._state = params == ["on"]
+            self.coordinator.async_set(*self.state_to_data(self._state))
 
 
 class XiaomiGatewayRadioSwitch(XiaomiGatewayGenericSwitch):
@@ -228,25 +301,29 @@ class XiaomiGatewayRadioSwitch(XiaomiGatewayGenericSwitch):
             **self._gw_attrs
             }
 
-    def turn_on(self, **kwargs):
+    async def async_turn_on(self, **kwargs):
         """Turn the switch on."""
-        if 'ok' in self.miio.raw_command('play_fm', ["on"]):
-            self._state = True
+        await self._async_send('play_fm', "on")
         _LOGGER.debug(f"{self._name} Radio ON")
 
-    def turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         """Turn the switch off."""
-        if 'ok' in self.miio.raw_command('play_fm', ["off"]):
-            self._state = False
+        await self._async_send('play_fm', "off")
         _LOGGER.debug(f"{self._name} Radio OFF")
 
-    def update(self):
-        """Get data from hub."""
-        _LOGGER.debug("Update radio state from hub: %s", self._name)
-        resp = self.miio.raw_command("get_prop_fm", [])
+    def update_from_data(self, data):
+        """Get radio state from the coordinator data."""
+        resp = data.get("fm")
+        if resp is None:
+            return
         self._volume = resp.get("current_volume")
         self._state = resp.get("current_status") == 'run'
 
+    def state_to_data(self, state):
+        """Return the radio data with the confirmed play state."""
+        fm_data = self.coordinator.data.get("fm", {})
+        return "fm", {**fm_data, "current_status": "run" if state else "pause"}
+
 
 class XiaomiGatewayAlarmSwitch(XiaomiGatewayGenericSwitch):
     """Xiaomi Gateway Radio Switch"""
@@ -265,22 +342,23 @@ class XiaomiGatewayAlarmSwitch(XiaomiGatewayGenericSwitch):
         """Add Radio Volume to the state attributes."""
         return self._gw_attrs
 
-    def turn_on(self, **kwargs):
+    async def async_turn_on(self, **kwargs):
         """Turn the switch on."""
-        if 'ok' in self.miio.raw_command('set_arming', ["on"]):
-            self._state = True
+        await self._async_send('set_arming', "on")
         _LOGGER.debug(f"{self._name} Alarm ON")
 
-    def turn_off(self, **kwargs):
+    async def async_turn_off(self, **kwargs):
         """Turn the switch off."""
-        if 'ok' in self.miio.raw_command('set_arming', ["off"]):
-            self._state = False
+        await self._async_send('set_arming', "off")
         _LOGGER.debug(f"{self._name} Alarm OFF")
 
-    def update(self):
-        """Get alarm state from hub."""
-        _LOGGER.debug("Update alarm state from hub: %s", self._name)
-        resp = self.miio.raw_command("get_arming", [])
+    def update_from_data(self, data):
+        """Get alarm state from the coordinator data."""
+        resp = data.get("arming")
+        if resp is None:
+            return
         self._state = 'on' in resp
 
-
+    def state_to_data(self, state):
+        """Return the confirmed arming state."""
+        return "arming", ["on" if state else "off"]
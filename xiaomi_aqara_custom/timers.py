@@ -0,0 +1,95 @@
+"""Shared timers of the entities of a Xiaomi Gateway."""
+from datetime import timedelta
+import heapq
+import itertools
+
+from homeassistant.core import callback
+from homeassistant.helpers.event import async_track_time_interval
+
+TICK_INTERVAL = timedelta(seconds=1)
+SWEEP_INTERVAL = timedelta(seconds=30)
+
+
+class GatewayTimers:
+    """Expire the last-seen times and deadlines of a gateway's entities.
+
+    Messages only record a timestamp and re-arming a deadline only pushes
+    it on a heap, so no loop timer is created per message. A single tick
+    runs the due deadlines and, every SWEEP_INTERVAL, marks the entities
+    which were not seen for the timeout as unavailable.
+    """
+
+    def __init__(self, hass, timeout, interval=TICK_INTERVAL):
+        """Initialize the timers, call async_start to start ticking."""
+        self.hass = hass
+        self._timeout = timeout.total_seconds()
+        self._interval = interval
+        self._last_seen = {}
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._next_sweep = 0
+        self._unsub_tick = None
+
+    @property
+    def _now(self):
+        return self.hass.loop.time()
+
+    @callback
+    def async_start(self):
+        """Start ticking."""
+        if self._unsub_tick is None:
+            self._next_sweep = self._now + SWEEP_INTERVAL.total_seconds()
+            self._unsub_tick = async_track_time_interval(
+                self.hass, self._async_tick, self._interval
+            )
+
+    @callback
+    def async_stop(self):
+        """Stop ticking."""
+        if self._unsub_tick is not None:
+            self._unsub_tick()
+            self._unsub_tick = None
+
+    @callback
+    def async_seen(self, entity):
+        """Record that an entity received data."""
+        self._last_seen[entity] = self._now
+
+    @callback
+    def async_forget(self, entity):
+        """Stop tracking an entity."""
+        self._last_seen.pop(entity, None)
+
+    @callback
+    def async_call_later(self, delay, action):
+        """Call action(now) after delay seconds, returns a cancel callback."""
+        entry = [self._now + delay, next(self._counter), action]
+        heapq.heappush(self._deadlines, entry)
+
+        @callback
+        def cancel():
+            """Drop the call, its entry is discarded when due."""
+            entry[2] = None
+
+        return cancel
+
+    @callback
+    def _async_tick(self, now):
+        """Run the due deadlines and sweep the last-seen times."""
+        loop_now = self._now
+        while self._deadlines and self._deadlines[0][0] <= loop_now:
+            _, _, action = heapq.heappop(self._deadlines)
+            if action is not None:
+                action(now)
+
+        if loop_now < self._next_sweep:
+            return
+        self._next_sweep = loop_now + SWEEP_INTERVAL.total_seconds()
+        expired = [
+            entity
+            for entity, seen in self._last_seen.items()
+            if loop_now - seen > self._timeout
+        ]
+        for entity in expired:
+            del self._last_seen[entity]
+            entity.async_set_unavailable(now)
@@ -0,0 +1,480 @@
+"""Asyncio write path of a Xiaomi Gateway."""
+import asyncio
+from collections import OrderedDict
+import itertools
+import json
+import logging
+import re
+import socket
+
+from homeassistant.core import callback
+from xiaomi_gateway import _list2map, _validate_data, _validate_keyerror
+
+_LOGGER = logging.getLogger(__name__)
+
+# The first retransmission waits WRITE_TIMEOUT, every next one twice as
+# long up to WRITE_TIMEOUT_MAX, so a write gives up after about 7.5 s.
+WRITE_TIMEOUT = 0.5
+WRITE_TIMEOUT_MAX = 4.0
+WRITE_ATTEMPTS = 4
+
+# Datagrams per second sent to a gateway, and how many may go at once
+WRITE_RATE = 10.0
+WRITE_BURST = 5
+# Writes waiting per priority, further writes are rejected
+WRITE_QUEUE_SIZE = 32
+# Time an idle writer waits for more writes to the same switch to merge
+WRITE_BATCH_WINDOW = 0.05
+# Keys of the channels of multi-channel switches, the only writes merged
+CHANNEL_KEY = re.compile(r"channel_\d+$")
+
+# Lower values are sent first
+WRITE_PRIORITY_SAFETY = 0
+WRITE_PRIORITY_NORMAL = 1
+WRITE_PRIORITY_COMFORT = 2
+WRITE_PRIORITIES = (
+    WRITE_PRIORITY_SAFETY,
+    WRITE_PRIORITY_NORMAL,
+    WRITE_PRIORITY_COMFORT,
+)
+
+
+def _is_channel_write(keys):
+    """Return True if a write only sets channels of a switch."""
+    return all(CHANNEL_KEY.match(key) for key in keys)
+
+
+class _Preempted(Exception):
+    """A safety write is waiting, the write in flight steps aside."""
+
+
+class _WriteProtocol(asyncio.DatagramProtocol):
+    """Hand the answers of a gateway to its writer."""
+
+    def __init__(self, writer):
+        """Initialize the protocol."""
+        self._writer = writer
+
+    def datagram_received(self, data, addr):
+        """Pass an answer to the writer."""
+        self._writer.answer_received(data)
+
+    def error_received(self, exc):
+        """Log socket errors, the pending writes time out on their own."""
+        _LOGGER.debug("Write socket error: %s", exc)
+
+
+class GatewayWriter:
+    """Send the writes of a gateway one at a time, on the event loop.
+
+    A pending write of the same keys of a device is replaced by a later
+    one, so ramping a light only sends its latest colour. Every caller of a
+    replaced write gets the outcome of the write actually sent.
+
+    Writes are queued by priority, so stopping an alarm goes ahead of a
+    scene changing light colours. A safety write also preempts a lower
+    write waiting for its answer, which is queued again in front, and
+    datagrams are paced by a token bucket of WRITE_RATE per second, as the
+    gateway drops commands arriving in a burst.
+
+    Queued writes to different channels of the same switch are merged into
+    one, so switching both channels of a double wall switch takes a single
+    write. A writer started by such a write waits WRITE_BATCH_WINDOW for
+    the others to arrive, unless a safety write comes first.
+
+    The gateway answers a write with write_ack (write_rsp for protocol 2)
+    and usually reports the new values too, either confirms the write. A
+    write without answer is sent again with exponential backoff, one
+    rejected for an invalid key is sent again after fetching a new token.
+    """
+
+    def __init__(
+        self,
+        hass,
+        gateway,
+        timeout=WRITE_TIMEOUT,
+        max_timeout=WRITE_TIMEOUT_MAX,
+        attempts=WRITE_ATTEMPTS,
+        rate=WRITE_RATE,
+        burst=WRITE_BURST,
+        queue_size=WRITE_QUEUE_SIZE,
+        batch_window=WRITE_BATCH_WINDOW,
+    ):
+        """Initialize the writer, the socket is opened on first use."""
+        self.hass = hass
+        self._gateway = gateway
+        self._timeout = timeout
+        self._max_timeout = max_timeout
+        self._attempts = attempts
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._refilled = hass.loop.time()
+        self._queue_size = queue_size
+        self._batch_window = batch_window
+        self._queues = {priority: OrderedDict() for priority in WRITE_PRIORITIES}
+        self._acks = {}
+        self._write_ids = itertools.count(1)
+        self._inflight = None
+        self._current = None
+        self._discarded = False
+        self._preempt = None
+        self._wakeup = None
+        self._transport = None
+        self._worker = None
+        self._closed = False
+
+    async def async_write(self, sid, data, priority=WRITE_PRIORITY_NORMAL):
+        """Queue a write and return True once the gateway acknowledged it."""
+        queue = self._queues[priority]
+        key = (sid, tuple(sorted(data)))
+        queued = queue.pop(key, None)
+        if queued is None:
+            if len(queue) >= self._queue_size:
+                self._gateway.stats["write_rejected"] += 1
+                _LOGGER.warning(
+                    "Write queue of %s is full, dropping write of %s to %s",
+                    self._gateway.sid,
+                    data,
+                    sid,
+                )
+                return False
+            queued = (data, [], self.hass.loop.time())
+        future = self.hass.loop.create_future()
+        queued[1].append(future)
+        queue[key] = (data, queued[1], queued[2])
+        self._update_depth()
+
+        if priority == WRITE_PRIORITY_SAFETY:
+            for waiter in (self._preempt, self._wakeup):
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+        if self._worker is None:
+            self._worker = self.hass.async_create_task(self._async_run())
+        return await future
+
+    @callback
+    def async_discard(self, sid, data_key):
+        """Fail the queued writes of a device containing data_key.
+
+        A matching write in flight is preempted and not sent again.
+        """
+        for queue in self._queues.values():
+            for key in [key for key in queue if key[0] == sid and data_key in key[1]]:
+                for future in queue.pop(key)[1]:
+                    if not future.done():
+                        future.set_result(False)
+        self._update_depth()
+        current = self._current
+        if current is not None and current[0] == sid and data_key in current[1]:
+            self._discarded = True
+            if self._preempt is not None and not self._preempt.done():
+                self._preempt.set_result(None)
+
+    def _wants_batch(self):
+        """Return True if channel writes wait and no safety write does."""
+        if self._queues[WRITE_PRIORITY_SAFETY]:
+            return False
+        return any(
+            _is_channel_write(keys)
+            for queue in self._queues.values()
+            for _, keys in queue
+        )
+
+    def _update_depth(self):
+        self._gateway.stats["write_queue_depth"] = sum(map(len, self._queues.values()))
+
+    def _next_write(self):
+        """Pop the oldest write of the highest priority, or None.
+
+        Returns (priority, sid, (data, futures, queued_at)). The writes of
+        the same priority to other channels of its switch are merged into it.
+        """
+        for priority in WRITE_PRIORITIES:
+            queue = self._queues[priority]
+            if queue:
+                break
+        else:
+            return None
+
+        (sid, keys), (data, futures, queued_at) = queue.popitem(last=False)
+        merged = set(keys)
+        for key in list(queue) if _is_channel_write(keys) else ():
+            if (
+                key[0] == sid
+                and _is_channel_write(key[1])
+                and merged.isdisjoint(key[1])
+            ):
+                other_data, other_futures, _ = queue.pop(key)
+                data = {**data, **other_data}
+                futures = futures + other_futures
+                merged.update(key[1])
+                self._gateway.stats["writes_merged"] += 1
+        self._update_depth()
+        return priority, sid, (data, futures, queued_at)
+
+    def _requeue(self, priority, sid, write):
+        """Put a preempted write back in front of its queue.
+
+        A write of the same keys queued meanwhile is newer and is sent
+        instead, for the callers of both.
+        """
+        data, futures, queued_at = write
+        queue = self._queues[priority]
+        key = (sid, tuple(sorted(data)))
+        queued = queue.get(key)
+        if queued is not None:
+            queued[1].extend(futures)
+            return
+        queue[key] = write
+        queue.move_to_end(key, last=False)
+        self._update_depth()
+
+    async def _async_run(self):
+        """Send the queued writes."""
+        stats = self._gateway.stats
+        try:
+            if self._wants_batch():
+                self._wakeup = self.hass.loop.create_future()
+                try:
+                    await asyncio.wait({self._wakeup}, timeout=self._batch_window)
+                finally:
+                    self._wakeup = None
+            while True:
+                queued = self._next_write()
+                if queued is None:
+                    break
+                priority, sid, write = queued
+                data, futures, queued_at = write
+                wait = round((self.hass.loop.time() - queued_at) * 1000)
+                stats["write_wait_ms"] = wait
+                stats["write_wait_max_ms"] = max(stats["write_wait_max_ms"], wait)
+                if priority != WRITE_PRIORITY_SAFETY:
+                    self._preempt = self.hass.loop.create_future()
+                self._current = (sid, data)
+                self._discarded = False
+                try:
+                    result = await self._async_deliver(sid, data)
+                except _Preempted:
+                    if self._discarded:
+                        result = False
+                    else:
+                        stats["writes_preempted"] += 1
+                        self._requeue(priority, sid, write)
+                        continue
+                except Exception:  # pylint: disable=broad-except
+                    _LOGGER.exception("Write of %s to %s failed", data, sid)
+                    stats["write_failures"] += 1
+                    result = False
+                finally:
+                    self._preempt = None
+                    self._current = None
+                for future in futures:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self._worker = None
+
+    async def _async_take_token(self):
+        """Wait until the token bucket allows another datagram."""
+        loop = self.hass.loop
+        while True:
+            now = loop.time()
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._refilled) * self._rate
+            )
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    async def _async_connect(self):
+        """Open the socket, bound to the interface of the gateway."""
+        if self._transport is None and not self._closed:
+            interface = self._gateway.interface
+            if interface == "any":
+                kwargs = {"family": socket.AF_INET}
+            else:
+                kwargs = {"local_addr": (interface, 0)}
+            self._transport, _ = await self.hass.loop.create_datagram_endpoint(
+                lambda: _WriteProtocol(self), **kwargs
+            )
+
+    @property
+    def _proto_v1(self):
+        return int(self._gateway.proto[0:1]) == 1
+
+    def _command(self, sid, data):
+        """Build a write command, returns (command, answer cmd)."""
+        key = self._gateway._get_key()  # pylint: disable=protected-access
+        cmd = {"cmd": "write", "sid": sid}
+        if self._proto_v1:
+            cmd["data"] = dict(data, key=key)
+            return cmd, "write_ack"
+        cmd["key"] = key
+        cmd["params"] = [data]
+        return cmd, "write_rsp"
+
+    async def _async_request(self, sid, cmd, answer_cmd, timeout, written=None):
+        """Send a command, returns its answer or None after timeout.
+
+        A report of the written values answers a write as well. Raises
+        _Preempted when a safety write arrives meanwhile.
+        """
+        await self._async_take_token()
+        if self._closed:
+            return None
+        if self._preempt is not None and self._preempt.done():
+            raise _Preempted
+        future = self._acks[(sid, answer_cmd)] = self.hass.loop.create_future()
+        if written is not None:
+            self._inflight = (sid, written, future)
+        gateway = self._gateway
+        self._transport.sendto(
+            json.dumps(cmd).encode(), (gateway.ip_adress, gateway.port)
+        )
+        waiters = {future}
+        if self._preempt is not None:
+            waiters.add(self._preempt)
+        try:
+            await asyncio.wait(
+                waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if future.done():
+                return future.result()
+            if self._preempt is not None and self._preempt.done():
+                raise _Preempted
+            return None
+        finally:
+            if self._acks.get((sid, answer_cmd)) is future:
+                del self._acks[(sid, answer_cmd)]
+
+    async def _async_deliver(self, sid, data):
+        """Send one write until the gateway confirms it or attempts run out."""
+        gateway = self._gateway
+        if gateway.key is None:
+            _LOGGER.error(
+                "Gateway Key is not provided. Can not send commands to the gateway."
+            )
+            return False
+
+        await self._async_connect()
+        if not gateway.token:
+            _LOGGER.debug("Gateway Token was not obtained yet, fetching one")
+            if not await self._async_refresh_token():
+                gateway.stats["write_failures"] += 1
+                return False
+        write_id = next(self._write_ids)
+        timeout = self._timeout
+        refreshed = False
+        try:
+            for attempt in range(self._attempts):
+                if attempt:
+                    gateway.stats["write_retries"] += 1
+                if self._closed:
+                    return False
+                cmd, answer_cmd = self._command(sid, data)
+                _LOGGER.debug("write %s >> %s: %s", write_id, sid, data)
+                resp = await self._async_request(
+                    sid, cmd, answer_cmd, timeout, written=data
+                )
+                if resp is None:
+                    _LOGGER.debug("No answer to write %s", write_id)
+                    timeout = min(timeout * 2, self._max_timeout)
+                    continue
+                _LOGGER.debug("write %s << %s", write_id, resp)
+                if resp.get("cmd") == "report":
+                    return True
+                if _validate_keyerror(resp) and not refreshed:
+                    refreshed = True
+                    if await self._async_refresh_token():
+                        continue
+                    break
+                if _validate_data(resp):
+                    return True
+                break
+        finally:
+            self._inflight = None
+
+        gateway.stats["write_failures"] += 1
+        _LOGGER.warning("Write of %s to %s failed", data, sid)
+        return False
+
+    async def _async_refresh_token(self):
+        """Fetch a new token from the gateway, returns True on success."""
+        gateway = self._gateway
+        if self._proto_v1:
+            cmd, answer_cmd = {"cmd": "get_id_list"}, "get_id_list_ack"
+        else:
+            cmd, answer_cmd = {"cmd": "discovery"}, "discovery_rsp"
+        resp = await self._async_request(
+            gateway.sid, cmd, answer_cmd, self._max_timeout
+        )
+        _LOGGER.debug("%s << %s", answer_cmd, resp)
+        if resp is None or "token" not in resp:
+            _LOGGER.error(
+                "No new token from gateway. Can not send commands to the gateway."
+            )
+            return False
+        gateway.token = resp["token"]
+        gateway.stats["token_refreshes"] += 1
+        return True
+
+    def answer_received(self, data):
+        """Resolve the request an answer belongs to."""
+        try:
+            resp = json.loads(data.decode())
+        except ValueError:
+            _LOGGER.debug("Cannot decode answer of %s", self._gateway.sid)
+            return
+        future = self._acks.get((resp.get("sid"), resp.get("cmd")))
+        if future is not None and not future.done():
+            future.set_result(resp)
+
+    @callback
+    def async_message_received(self, message):
+        """Confirm the write in flight from a raw multicast message.
+
+        Called before duplicate suppression, so a report repeating the
+        previous one of the device still confirms the write.
+        """
+        if self._inflight is None:
+            return
+        try:
+            report = json.loads(message.decode())
+            if report.get("cmd") != "report":
+                return
+            if "params" in report:
+                data = _list2map(report["params"])
+            else:
+                data = json.loads(report["data"])
+            self._report_received(report["sid"], data, report)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return
+
+    def _report_received(self, sid, data, raw_data):
+        """Confirm the write in flight if a report shows its values."""
+        write_sid, written, future = self._inflight
+        if write_sid != sid or future.done():
+            return
+        for key, value in written.items():
+            if key not in data or str(data[key]) != str(value):
+                return
+        future.set_result(raw_data)
+
+    def close(self):
+        """Close the socket and fail the pending writes."""
+        self._closed = True
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        for queue in self._queues.values():
+            for _, futures, _ in queue.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_result(False)
+            queue.clear()
+        for future in self._acks.values():
+            if not future.done():
+                future.set_result(None)